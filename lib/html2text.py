@@ -30,6 +30,14 @@ try: #Python3
     import urllib.request as urllib
 except:
     import urllib
+try:
+    from xml.parsers import expat
+except ImportError:
+    expat = None
+try: #Python3.4
+    from html import unescape as html_unescape
+except ImportError:
+    html_unescape = None
 import optparse, re, sys, codecs, types
 
 try: from textwrap import wrap
@@ -95,6 +103,10 @@ unifiable_n = {}
 for k in unifiable.keys():
     unifiable_n[name2cp(k)] = unifiable[k]
 
+# Non-breaking spaces are put in at the end (see HTML2Text.take_output).
+del unifiable_n[name2cp('nbsp')]
+unifiable['nbsp'] = '&nbsp_place_holder;'
+
 ### End Entity Nonsense ###
 
 def onlywhite(line):
@@ -195,11 +207,13 @@ def list_numbering_start(attrs):
     else:
         return 0
 
-class HTML2Text(HTMLParser.HTMLParser):
-    def __init__(self, out=None, baseurl=''):
-        HTMLParser.HTMLParser.__init__(self)
+class Config(object):
+    """The options of a conversion, named like the `HTML2Text` attributes
+    they set. The ones not given are the module globals of when the Config
+    is made: a converter only reads its Config, so converters with
+    different Configs can run at the same time in several threads."""
 
-        # Config options
+    def __init__(self, **options):
         self.unicode_snob = UNICODE_SNOB
         self.escape_snob = ESCAPE_SNOB
         self.links_each_paragraph = LINKS_EACH_PARAGRAPH
@@ -211,9 +225,24 @@ class HTML2Text(HTMLParser.HTMLParser):
         self.ignore_images = IGNORE_IMAGES
         self.ignore_emphasis = IGNORE_EMPHASIS
         self.google_doc = False
+        self.hide_strikethrough = False
         self.ul_item_mark = UL_ITEM_MARK
         self.emphasis_mark = EMPHASIS_MARK
         self.strong_mark = STRONG_MARK
+        for name in options:
+            if not hasattr(self, name):
+                raise TypeError("unknown html2text option %r" % name)
+            setattr(self, name, options[name])
+
+class HTML2Text(HTMLParser.HTMLParser):
+    def __init__(self, out=None, baseurl='', config=None):
+        HTMLParser.HTMLParser.__init__(self)
+
+        # Config options
+        if config is None:
+            config = Config()
+        self.config = config
+        self.__dict__.update(vars(config))
 
         if out is None:
             self.out = self.outtextf
@@ -259,10 +288,7 @@ class HTML2Text(HTMLParser.HTMLParser):
         self.abbr_list = {}  # stack of abbreviations to write later
         self.baseurl = baseurl
         self.span_stack = []
-
-        try: del unifiable_n[name2cp('nbsp')]
-        except KeyError: pass
-        unifiable['nbsp'] = '&nbsp_place_holder;'
+        self.bq_prefixes = {}  # line prefix for each nesting, see bq_prefix
 
 
     def feed(self, data):
@@ -274,22 +300,61 @@ class HTML2Text(HTMLParser.HTMLParser):
         self.feed("")
         return self.optwrap(self.close())
 
+    def handle_iter(self, chunks):
+        """Convert the HTML coming in `chunks` (strings, or UTF-8 encoded
+        bytes), yielding the text as it is produced instead of returning
+        it all at the end.
+
+        Each chunk is only parsed up to its last '<', so that the parser
+        never sees a text node cut in two: put together, the fragments are
+        the text `handle` returns for the whole HTML. Wrapping (see
+        `body_width`) needs the whole text, so with it the text is yielded
+        in one piece at the end.
+        """
+        decoder = None
+        pending = ''
+        for chunk in chunks:
+            if isinstance(chunk, bytes):
+                if decoder is None:
+                    decoder = codecs.getincrementaldecoder('utf-8')()
+                chunk = decoder.decode(chunk)
+            pending += chunk
+            cut = pending.rfind('<')
+            if cut > 0:
+                self.feed(pending[:cut])
+                pending = pending[cut:]
+                if not self.body_width:
+                    text = self.take_output()
+                    if text: yield text
+        if decoder is not None:
+            pending += decoder.decode(b'', True)
+        self.feed(pending)
+        self.feed("")
+        text = self.optwrap(self.close())
+        if text: yield text
+
     def outtextf(self, s):
         self.outtextlist.append(s)
         if s: self.lastWasNL = s[-1] == '\n'
 
+    def take_output(self):
+        """Return the text output since the last call (or since the start),
+        with its non-breaking spaces put in."""
+        text = u''.join(self.outtextlist)
+        del self.outtextlist[:]
+        if self.unicode_snob:
+            nbsp = chr(name2cp('nbsp'))
+        else:
+            nbsp = u' '
+        return text.replace(u'&nbsp_place_holder;', nbsp)
+
     def close(self):
         HTMLParser.HTMLParser.close(self)
 
         self.pbr()
         self.o('', 0, 'end')
 
-        self.outtext = self.outtext.join(self.outtextlist)
-        if self.unicode_snob:
-            nbsp = chr(name2cp('nbsp'))
-        else:
-            nbsp = u' '
-        self.outtext = self.outtext.replace(u'&nbsp_place_holder;', nbsp)
+        self.outtext = self.take_output()
 
         return self.outtext
 
@@ -724,7 +789,7 @@ class HTML2Text(HTMLParser.HTMLParser):
                     self.drop_white_space = 0
 
             if puredata and not self.pre:
-                data = re.sub('\s+', ' ', data)
+                data = whitespace_matcher.sub(' ', data)
                 if data and data[0] == ' ':
                     self.space = 1
                     data = data[1:]
@@ -735,15 +800,11 @@ class HTML2Text(HTMLParser.HTMLParser):
                 if not data.startswith("\n"):  # <pre>stuff...
                     data = "\n" + data
 
-            bq = (">" * self.blockquote)
-            if not (force and data and data[0] == ">") and self.blockquote: bq += " "
-
-            if self.pre == "indent":
-                if not self.list:
-                    bq += "    "
-                #else: list content is already partially indented
-                for i in xrange(len(self.list)):
-                    bq += "    "
+            indent = self.pre == "indent"
+            bq = self.bq_prefix(self.blockquote,
+                                not (force and data and data[0] == ">"),
+                                len(self.list) if indent else None)
+            if indent:
                 data = data.replace("\n", "\n"+bq)
 
             if self.startpre:
@@ -795,6 +856,24 @@ class HTML2Text(HTMLParser.HTMLParser):
             self.out(data)
             self.outcount += 1
 
+    def bq_prefix(self, blockquote, space, list_depth):
+        """Return the prefix of the lines at the given nesting: the
+        blockquote marks, followed by a space unless `space` is false,
+        and the indentation of a code block in `list_depth` lists unless
+        that is None."""
+        key = (blockquote, space, list_depth)
+        try:
+            return self.bq_prefixes[key]
+        except KeyError:
+            pass
+        bq = (">" * blockquote)
+        if space and blockquote: bq += " "
+        if list_depth is not None:
+            # list content is already partially indented
+            bq += "    " * (list_depth or 1)
+        self.bq_prefixes[key] = bq
+        return bq
+
     def handle_data(self, data):
         if r'\/script>' in data: self.quiet -= 1
 
@@ -874,41 +953,173 @@ class HTML2Text(HTMLParser.HTMLParser):
             return text
 
         assert wrap, "Requires Python 2.3."
-        result = ''
+        result = []
         newlines = 0
         in_fence = False
         for para in text.split("\n"):
             if in_fence:
                 if para.lstrip(' \t').startswith("`" * in_fence):
                     in_fence = False
-                    result += para + "\n\n"
+                    result.append(para + "\n\n")
                 else:
-                    result += para + "\n"
+                    result.append(para + "\n")
             elif para.lstrip(' \t').startswith("```"):
                 in_fence = para.count("`")
-                result += para + "\n"
+                result.append(para + "\n")
             else:
                 if len(para) > 0:
                     if not skipwrap(para):
-                        result += "\n".join(wrap(para, self.body_width))
+                        result.append("\n".join(wrap(para, self.body_width)))
                         if para.endswith('  '):
-                            result += "  \n"
+                            result.append("  \n")
                             newlines = 1
                         else:
-                            result += "\n\n"
+                            result.append("\n\n")
                             newlines = 2
                     else:
                         if not onlywhite(para):
-                            result += para + "\n"
+                            result.append(para + "\n")
                             newlines = 1
                 else:
                     if newlines < 2:
-                        result += "\n"
+                        result.append("\n")
                         newlines += 1
-        return result
+        return ''.join(result)
+
+class ENML2Text(HTML2Text):
+    """Converts ENML, the XML flavour of XHTML Evernote stores notes in.
+
+    ENML is well-formed XML, so `handle` reads the elements with expat
+    instead of the HTMLParser, and gives them to the same tag and data
+    handlers, called the way the HTMLParser would (self-closing tags such
+    as en-media and en-todo with `handle_startendtag`, the text with the
+    entity and character references left in it). The markdown is the one
+    `HTML2Text` makes. Content that is not well-formed XML, that does not
+    have an en-note root, or that expat and the HTMLParser would read
+    differently goes through `HTML2Text` instead. `handle_iter` is the
+    `HTML2Text` one.
+    """
 
+    def handle(self, data):
+        if expat is None:
+            return HTML2Text.handle(self, data)
+        try:
+            calls = self.enml_calls(data)
+        except (expat.ExpatError, ValueError):
+            return HTML2Text.handle(self, data)
+        calls = iter(calls)
+        for handler, arg, attrs in zip(calls, calls, calls):
+            if attrs is None:
+                handler(arg)
+            else:
+                handler(arg, attrs)
+        return self.optwrap(self.close())
+
+    def enml_calls(self, data):
+        """Parse `data` and return the handler calls for it, as a flat
+        list of (handler, tag or data, attributes or None). Raises ValueError on content to leave to
+        the HTMLParser."""
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        calls = []
+        add = calls.extend
+        handle_starttag = self.handle_starttag
+        handle_startendtag = self.handle_startendtag
+        handle_endtag = self.handle_endtag
+        handle_data = self.handle_data
+        parser = expat.ParserCreate('utf-8')
+        parser.ordered_attributes = True
+        # [end of the last tag, whether the last start tag closed itself]
+        state = [0, False]
+
+        def text_before(index):
+            text = data[state[0]:index].decode('utf-8')
+            if '&' in text or '<' in text:
+                self.enml_text(text, calls)
+            else:
+                add((handle_data, text, None))
+
+        def start(name, attrs):
+            if not calls and name != 'en-note':
+                raise ValueError("not an en-note")
+            if name in ('script', 'style'):
+                raise ValueError("%s content" % name)
+            index = parser.CurrentByteIndex
+            if index > state[0]:
+                text_before(index)
+            if attrs:
+                end = enml_tag_end.match(data, index + 1).end()
+                if enml_space_matcher.search(data, index, end):
+                    # expat normalizes the white space of attribute values
+                    raise ValueError("attributes on several lines")
+                names = name + ''.join(attrs[::2])
+                attrs = list(zip(attrs[::2], attrs[1::2]))
+            else:
+                end = data.index(b'>', index) + 1
+                names = name
+            if names != names.lower():
+                # the HTMLParser lower-cases them
+                raise ValueError("upper case names")
+            if data[end - 2:end] == b'/>':
+                state[1] = True
+                add((handle_startendtag, name, attrs))
+            else:
+                add((handle_starttag, name, attrs))
+            state[0] = end
+
+        def end(name):
+            if state[1]:
+                # the end of a self-closing tag: handled with its start
+                state[1] = False
+                return
+            index = parser.CurrentByteIndex
+            if index > state[0]:
+                text_before(index)
+            add((handle_endtag, name, None))
+            state[0] = data.index(b'>', index) + 1
+
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.Parse(data, True)
+        if len(data) > state[0]:
+            text_before(len(data))
+        return calls
+
+    def enml_text(self, text, calls):
+        """Add the calls for the text between two tags, which may hold
+        comments, declarations and references."""
+        add = calls.extend
+        for i, part in enumerate(enml_markup_matcher.split(text)):
+            if i % 2 or not part:
+                continue  # comments, declarations and processing instructions
+            if '<' in part:
+                raise ValueError("unexpected markup")
+            if getattr(self, 'convert_charrefs', False):
+                add((self.handle_data, html_unescape(part), None))
+                continue
+            refs = list(enml_ref_matcher.finditer(part))
+            if len(refs) != part.count('&'):
+                raise ValueError("unexpected reference")
+            pos = 0
+            for ref in refs:
+                if ref.start() > pos:
+                    add((self.handle_data, part[pos:ref.start()], None))
+                if ref.group(1):
+                    add((self.handle_charref, ref.group(1), None))
+                else:
+                    add((self.handle_entityref, ref.group(2), None))
+                pos = ref.end()
+            if pos < len(part):
+                add((self.handle_data, part[pos:], None))
+
+
+whitespace_matcher = re.compile(r'\s+')
 ordered_list_matcher = re.compile(r'\d+\.\s')
 unordered_list_matcher = re.compile(r'[-\*\+]\s')
+enml_tag_end = re.compile(br'''[^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>''')
+enml_space_matcher = re.compile(br'[\t\n\r]')
+enml_markup_matcher = re.compile(r'(<!--.*?-->|<\?[^>]*>|<!DOCTYPE[^>\[]*>)', re.S)
+enml_ref_matcher = re.compile(r'&(?:#([0-9]+|[xX][0-9a-fA-F]+)|([a-zA-Z][-.a-zA-Z0-9]*));')
 md_chars_matcher = re.compile(r"([\\\[\]\(\)])")
 md_chars_matcher_all = re.compile(r"([`\*_{}\[\]\(\)#!])")
 md_dot_matcher = re.compile(r"""
@@ -964,13 +1175,24 @@ def wrapwrite(text):
     except AttributeError:
         sys.stdout.write(text)
 
-def html2text(html, baseurl=''):
-    h = HTML2Text(baseurl=baseurl)
+def html2text(html, baseurl='', config=None):
+    h = HTML2Text(baseurl=baseurl, config=config)
     return h.handle(html)
 
+def enml2text(enml, baseurl='', config=None):
+    """Like `html2text`, for the ENML contents of an Evernote note (see
+    `ENML2Text`)."""
+    h = ENML2Text(baseurl=baseurl, config=config)
+    return h.handle(enml)
+
+def html2text_iter(chunks, baseurl='', config=None):
+    """Like `html2text`, for HTML coming in chunks: yields the text as it
+    is produced (see `HTML2Text.handle_iter`)."""
+    h = HTML2Text(baseurl=baseurl, config=config)
+    return h.handle_iter(chunks)
+
 def unescape(s, unicode_snob=False):
-    h = HTML2Text()
-    h.unicode_snob = unicode_snob
+    h = HTML2Text(config=Config(unicode_snob=unicode_snob))
     return h.unescape(s)
 
 def escape_md(text):
@@ -979,12 +1201,17 @@ def escape_md(text):
 
 def escape_md_section(text, snob=False):
     """Escapes markdown-sensitive characters across whole document sections."""
-    text = md_backslash_matcher.sub(r"\\\1", text)
+    # Most text has none of the characters to escape: skip their patterns.
+    if '\\' in text:
+        text = md_backslash_matcher.sub(r"\\\1", text)
     if snob:
         text = md_chars_matcher_all.sub(r"\\\1", text)
-    text = md_dot_matcher.sub(r"\1\\\2", text)
-    text = md_plus_matcher.sub(r"\1\\\2", text)
-    text = md_dash_matcher.sub(r"\1\\\2", text)
+    if '.' in text:
+        text = md_dot_matcher.sub(r"\1\\\2", text)
+    if '+' in text:
+        text = md_plus_matcher.sub(r"\1\\\2", text)
+    if '-' in text:
+        text = md_dash_matcher.sub(r"\1\\\2", text)
     return text
 
 
@@ -1013,6 +1240,10 @@ def main():
         default=False, help="hide strike-through text. only relevant when -g is specified as well")
     p.add_option("--escape-all", action="store_true", dest="escape_snob",
         default=False, help="Escape all special characters.  Output is less readable, but avoids corner case formatting issues.")
+    p.add_option("--enml", action="store_true", dest="enml",
+        default=False, help="read the input as the ENML of an Evernote note")
+    p.add_option("--bench", dest="bench", action="store", type="int",
+        default=0, metavar="N", help="convert the input N times and print the best time, instead of the text")
     (options, args) = p.parse_args()
 
     # process input
@@ -1048,23 +1279,40 @@ def main():
         data = sys.stdin.read()
 
     data = data.decode(encoding)
-    h = HTML2Text(baseurl=baseurl)
+
     # handle options
-    if options.ul_style_dash: h.ul_item_mark = '-'
+    config = Config(body_width=options.body_width,
+                    google_list_indent=options.list_indent,
+                    ignore_emphasis=options.ignore_emphasis,
+                    ignore_links=options.ignore_links,
+                    ignore_images=options.ignore_images,
+                    google_doc=options.google_doc,
+                    hide_strikethrough=options.hide_strikethrough,
+                    escape_snob=options.escape_snob)
+    if options.ul_style_dash: config.ul_item_mark = '-'
     if options.em_style_asterisk:
-        h.emphasis_mark = '*'
-        h.strong_mark = '__'
-
-    h.body_width = options.body_width
-    h.list_indent = options.list_indent
-    h.ignore_emphasis = options.ignore_emphasis
-    h.ignore_links = options.ignore_links
-    h.ignore_images = options.ignore_images
-    h.google_doc = options.google_doc
-    h.hide_strikethrough = options.hide_strikethrough
-    h.escape_snob = options.escape_snob
-
-    wrapwrite(h.handle(data))
+        config.emphasis_mark = '*'
+        config.strong_mark = '__'
+
+    def converter():
+        if options.enml:
+            return ENML2Text(baseurl=baseurl, config=config)
+        return HTML2Text(baseurl=baseurl, config=config)
+
+    if options.bench:
+        import time
+        best = None
+        for i in xrange(options.bench):
+            h = converter()
+            start = time.time()
+            h.handle(data)
+            elapsed = time.time() - start
+            if best is None or elapsed < best: best = elapsed
+        sys.stdout.write("%d chars, best of %d: %.3fs (%d chars/s)\n"
+                         % (len(data), options.bench, best, len(data) / max(best, 1e-6)))
+        return
+
+    wrapwrite(converter().handle(data))
 
 
 if __name__ == "__main__":
@@ -93,6 +93,8 @@ import os
 import sys
 import re
 import logging
+import threading
+import time
 try:
     from hashlib import md5
 except ImportError:
@@ -137,14 +139,31 @@ log = logging.getLogger("markdown")
 
 DEFAULT_TAB_WIDTH = 4
 
+# The number of converters kept around per thread by `markdown()`, one for
+# each distinct configuration.
+MARKDOWNER_POOL_SIZE = 8
+_markdowner_pool = threading.local()
 
-SECRET_SALT = bytes(randint(0, 1000000))
+# The converter of a `markdown_many()` worker process.
+_worker_markdowner = None
+
+
+# `bytes(n)` is n zero bytes on Python 3: use the number's digits instead.
+SECRET_SALT = str(randint(0, 1000000)).encode("ascii")
 def _hash_text(s):
     return 'md5-' + md5(SECRET_SALT + s.encode("utf-8")).hexdigest()
 
-# Table of hash values for escaped characters:
-g_escape_table = dict([(ch, _hash_text(ch))
-    for ch in '\\`*_{}[]()>#+-.!'])
+# Placeholders stand in for the escaped characters, HTML and code that later
+# passes must leave alone. They are numbered per document (see
+# `Markdown._placeholder()`) and all put back in a single pass. The characters
+# delimiting them are dropped from the input.
+_placeholder_fmt = "\x02%d\x03"
+_placeholder_re = re.compile("\x02(\\d+)\x03")
+
+# Table of placeholders for escaped characters:
+_escape_chars = '\\`*_{}[]()>#+-.!'
+g_escape_table = dict([(ch, _placeholder_fmt % i)
+    for i, ch in enumerate(_escape_chars)])
 
 
 
@@ -164,18 +183,98 @@ def markdown_path(path, encoding="utf-8",
     fp = codecs.open(path, 'r', encoding)
     text = fp.read()
     fp.close()
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
+    return markdown(text, html4tags=html4tags, tab_width=tab_width,
                     safe_mode=safe_mode, extras=extras,
                     link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+                    use_file_vars=use_file_vars)
 
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
              use_file_vars=False):
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
-                    safe_mode=safe_mode, extras=extras,
-                    link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+    return _markdown(text, dict(html4tags=html4tags, tab_width=tab_width,
+                                safe_mode=safe_mode, extras=extras,
+                                link_patterns=link_patterns,
+                                use_file_vars=use_file_vars))
+
+def _markdown(text, config, out=None):
+    # Converters are reused across calls with the same configuration. Each
+    # thread has its own pool, and a converter is taken out of it while in
+    # use, so nested calls get a fresh one.
+    try:
+        pool = _markdowner_pool.converters
+    except AttributeError:
+        pool = _markdowner_pool.converters = {}
+    key = repr(sorted((name, sorted(value.items()) if isinstance(value, dict) else value)
+                      for name, value in config.items()))
+    markdowner = pool.pop(key, None)
+    if markdowner is None:
+        markdowner = Markdown(**config)
+    try:
+        if out is None:
+            return markdowner.convert(text)
+        markdowner.convert_to(text, out)
+    finally:
+        if len(pool) < MARKDOWNER_POOL_SIZE:
+            pool[key] = markdowner
+
+def markdown_to(text, out, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
+                safe_mode=None, extras=None, link_patterns=None,
+                use_file_vars=False):
+    """Convert `text` like `markdown`, but write the HTML to `out` (a
+    file-like object or a list) block by block. See `Markdown.convert_to`.
+    """
+    _markdown(text, dict(html4tags=html4tags, tab_width=tab_width,
+                         safe_mode=safe_mode, extras=extras,
+                         link_patterns=link_patterns,
+                         use_file_vars=use_file_vars), out)
+
+def markdown_many(texts, processes=None, html4tags=False,
+                  tab_width=DEFAULT_TAB_WIDTH, safe_mode=None, extras=None,
+                  link_patterns=None, use_file_vars=False):
+    """Convert each of `texts` like `markdown`, using a pool of
+    `processes` worker processes (as many as there are CPUs by default).
+
+    Each worker sets up a single converter for the given configuration
+    (regexes, inline CSS, Pygments formatters) and reuses it for all the
+    documents it gets. The results are returned in the order of `texts`,
+    each with an `elapsed` attribute: the seconds its conversion took.
+
+    With `processes=1`, or fewer than two texts, no process is started and
+    the texts are converted one after the other. That is the way to use it
+    where new Python processes cannot be started, e.g. in a Sublime Text
+    plugin.
+    """
+    config = dict(html4tags=html4tags, tab_width=tab_width,
+                  safe_mode=safe_mode, extras=extras,
+                  link_patterns=link_patterns, use_file_vars=use_file_vars)
+    texts = list(texts)
+    if processes == 1 or len(texts) < 2:
+        markdowner = Markdown(**config)
+        return [_convert_timed(markdowner, text) for text in texts]
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                initargs=(config,))
+    try:
+        results = pool.map(_worker_convert, texts)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+def _convert_timed(markdowner, text):
+    start = time.time()
+    html = markdowner.convert(text)
+    html.elapsed = time.time() - start
+    return html
+
+def _init_worker(config):
+    global _worker_markdowner
+    _worker_markdowner = Markdown(**config)
+
+def _worker_convert(text):
+    return _convert_timed(_worker_markdowner, text)
 
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
@@ -188,6 +287,8 @@ class Markdown(object):
 
     urls = None
     titles = None
+    footnotes = None
+    footnote_ids = None
     html_blocks = None
     html_spans = None
     html_removed_text = "[HTML_REMOVED]"  # for compat with markdown.py
@@ -197,6 +298,7 @@ class Markdown(object):
     list_level = 0
 
     _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
+    _line_ending_re = re.compile("\r\n|\r")
 
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
                  extras=None, link_patterns=None, use_file_vars=False):
@@ -227,23 +329,33 @@ class Markdown(object):
         if "toc" in self.extras and not "header-ids" in self.extras:
             self.extras["header-ids"] = None   # "toc" implies "header-ids"
         self._instance_extras = self.extras.copy()
+        self._instance_tag_attrs = self._tag_attrs_from_extras(self.extras)
 
         self.link_patterns = link_patterns
         self.use_file_vars = use_file_vars
-        self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
+        self._outdent_re = _outdent_re_from_tab_width(tab_width)
 
         self._escape_table = g_escape_table.copy()
+        self._base_placeholders = list(_escape_chars)
         if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
+            for ch in '"\'':
+                self._escape_table[ch] = \
+                    _placeholder_fmt % len(self._base_placeholders)
+                self._base_placeholders.append(ch)
+        self._placeholders = None
 
     def reset(self):
         self.urls = {}
         self.titles = {}
         self.html_blocks = {}
         self.html_spans = {}
+        self._balance_indexes = {}
         self.list_level = 0
+        self._last_li_endswith_two_eols = False
+        self._toc = None
+        self._reset_placeholders()
         self.extras = self._instance_extras.copy()
+        self._tag_attrs = self._instance_tag_attrs
         if "footnotes" in self.extras:
             self.footnotes = {}
             self.footnote_ids = []
@@ -268,11 +380,69 @@ class Markdown(object):
         # one article (e.g. an index page that shows the N most recent
         # articles):
         self.reset()
+        text = self._prepare(text)
+        text = self._render_body(text)
+        return self._finish(text)
+
+    # Roughly how much Markdown `convert_to` renders at a time.
+    stream_chunk_size = 16384
+
+    def convert_to(self, text, out):
+        """Convert the given text, writing the HTML to `out` as it is
+        rendered instead of returning it.
+
+        `out` is a file-like object or a list: the HTML is passed to its
+        `write` (or `append`) method a few top-level blocks at a time (about
+        `stream_chunk_size` characters of Markdown), as soon as they are
+        rendered, so the whole HTML is never held in memory. Link
+        definitions and footnotes are collected in a first pass over the
+        whole text, and the footnotes are written last. Put together, the
+        fragments are the HTML `convert` returns, but for the numbering of
+        footnotes referred to from several chunks: from one chunk to the
+        next, they are numbered in document order. Note that `postprocess`
+        is called on each fragment.
+
+        The safe mode, file variables and the "header-ids" extra need the
+        whole document, so with those the HTML is written in one piece.
+        """
+        write = getattr(out, "write", None) or out.append
+        if (self.safe_mode or self.use_file_vars
+                or "header-ids" in self.extras):
+            write(self.convert(text))
+            return
 
+        self.reset()
+        text = self._strip(self._prepare(text))
+        blocks = [block for block in self._split_blocks(text) if block.strip()]
+        if not blocks:
+            write(self._finish_fragment(self._run_block_gamut(text)))
+        sep = ""
+        chunk, size = [], 0
+        for i, block in enumerate(blocks):
+            chunk.append(block)
+            size += len(block)
+            if size >= self.stream_chunk_size or i == len(blocks) - 1:
+                html = self._run_block_gamut("\n\n".join(chunk))
+                write(sep + self._finish_fragment(html))
+                sep = "\n\n"
+                chunk, size = [], 0
+        if "footnotes" in self.extras and self.footnotes:
+            write(self._finish_fragment(self._add_footnotes("")))
+        write("\n")
+
+    def _prepare(self, text):
+        """Turn the given text into the prepared Markdown text that the
+        block gamut runs on: normalized line endings and whitespace, no
+        metadata, and preprocessed.
+        """
         if not isinstance(text, unicode):
             #TODO: perhaps shouldn't presume UTF-8 for string input?
             text = unicode(text, 'utf-8')
 
+        # These delimit placeholders.
+        if "\x02" in text or "\x03" in text:
+            text = text.replace("\x02", "").replace("\x03", "")
+
         if self.use_file_vars:
             # Look for emacs-style file variable hints.
             emacs_vars = self._get_emacs_vars(text)
@@ -288,9 +458,10 @@ class Markdown(object):
                     else:
                         ename, earg = e, None
                     self.extras[ename] = earg
+                self._tag_attrs = self._tag_attrs_from_extras(self.extras)
 
         # Standardize line endings:
-        text = re.sub("\r\n|\r", "\n", text)
+        text = self._line_ending_re.sub("\n", text)
 
         # Make sure $text ends with a couple of newlines:
         text += "\n\n"
@@ -308,8 +479,19 @@ class Markdown(object):
         if "metadata" in self.extras:
             text = self._extract_metadata(text)
 
-        text = self.preprocess(text)
+        return self.preprocess(text)
 
+    def _render_body(self, text):
+        """Turn the prepared Markdown text into the HTML body, before
+        footnotes are appended and special chars are unescaped.
+        """
+        return self._run_block_gamut(self._strip(text))
+
+    def _strip(self, text):
+        """Hash the code and raw HTML of the prepared Markdown text and
+        strip its link and footnote definitions, collecting them into the
+        document-wide tables: what the block gamut then runs on.
+        """
         if "fenced-code-blocks" in self.extras and not self.safe_mode:
             text = self._do_fenced_code_blocks(text)
 
@@ -328,24 +510,13 @@ class Markdown(object):
             # looks like a link defn:
             #   [^4]: this "looks like a link defn"
             text = self._strip_footnote_definitions(text)
-        text = self._strip_link_definitions(text)
-
-        text = self._run_block_gamut(text)
+        return self._strip_link_definitions(text)
 
+    def _finish(self, text):
         if "footnotes" in self.extras:
             text = self._add_footnotes(text)
 
-        text = self.postprocess(text)
-
-        text = self._unescape_special_chars(text)
-
-        if self.safe_mode:
-            text = self._unhash_html_spans(text)
-
-        if "nofollow" in self.extras:
-            text = self._a_nofollow.sub(r'<\1 rel="nofollow"\2', text)
-
-        text += "\n"
+        text = self._finish_fragment(text) + "\n"
 
         rv = UnicodeWithAttrs(text)
         if "toc" in self.extras:
@@ -354,6 +525,15 @@ class Markdown(object):
             rv.metadata = self.metadata
         return rv
 
+    def _finish_fragment(self, text):
+        text = self.postprocess(text)
+
+        text = self._unescape_special_chars(text)
+
+        if "nofollow" in self.extras:
+            text = self._a_nofollow.sub(r'<\1 rel="nofollow"\2', text)
+        return text
+
     def postprocess(self, text):
         """A hook for subclasses to do some postprocessing of the html, if
         desired. This is called before unescaping of special chars and
@@ -554,6 +734,9 @@ class Markdown(object):
         )
         """ % _block_tags_a,
         re.X | re.M)
+    _strict_tag_block_open_re = re.compile(r"^<(%s)\b" % _block_tags_a, re.M)
+    _strict_tag_block_close_re = re.compile(
+        r"^(?=</(%s)>[ \t]*(?=\n+|\Z))" % _block_tags_a, re.M)
 
     _block_tags_b = 'p|div|h[1-6]|blockquote|pre|table|dl|ol|ul|script|noscript|form|fieldset|iframe|math'
     _block_tags_b += _html5tags
@@ -570,6 +753,9 @@ class Markdown(object):
         )
         """ % _block_tags_b,
         re.X | re.M)
+    _liberal_tag_block_open_re = re.compile(r"^<(%s)\b" % _block_tags_b, re.M)
+    _liberal_tag_block_close_re = re.compile(
+        r"(?=</(%s)>[ \t]*(?=\n+|\Z))" % _block_tags_b)
 
     _html_markdown_attr_re = re.compile(
         r'''\s+markdown\s*=\s*("[0-9a-zA-Z]*"|'[0-9a-zA-Z]*')''')
@@ -586,16 +772,16 @@ class Markdown(object):
                     middle = '\n'.join(lines[1:-1])
                     last_line = lines[-1]
                     first_line = first_line[:m.start()] + first_line[m.end():]
-                    f_key = _hash_text(first_line)
+                    f_key = self._placeholder(first_line)
                     self.html_blocks[f_key] = first_line
-                    l_key = _hash_text(last_line)
+                    l_key = self._placeholder(last_line)
                     self.html_blocks[l_key] = last_line
                     return ''.join(["\n\n", f_key,
                         "\n\n", middle, "\n\n",
                         l_key, "\n\n"])
                 else:
                     html = html[:m.start()] + html[m.end():]
-        key = _hash_text(html)
+        key = self._placeholder(html)
         self.html_blocks[key] = html
         return "\n\n" + key + "\n\n"
 
@@ -628,10 +814,18 @@ class Markdown(object):
         # the inner nested divs must be indented.
         # We need to do this before the next, more liberal match, because the next
         # match will start at the first `<div>` and stop at the first `</div>`.
-        text = self._strict_tag_block_re.sub(hash_html_block_sub, text)
+        #
+        # Both passes only try to match at tags that have a closing tag
+        # somewhere after them: many unclosed tags would otherwise make
+        # them quadratic.
+        text = _sub_with_closers(self._strict_tag_block_re,
+            hash_html_block_sub, text, self._strict_tag_block_open_re,
+            self._strict_tag_block_close_re)
 
         # Now match more liberally, simply from `\n<tag>` to `</tag>\n`
-        text = self._liberal_tag_block_re.sub(hash_html_block_sub, text)
+        text = _sub_with_closers(self._liberal_tag_block_re,
+            hash_html_block_sub, text, self._liberal_tag_block_open_re,
+            self._liberal_tag_block_close_re)
 
         # Special case just for <hr />. It was easier to make a special
         # case than to make the other regex more complicated.
@@ -690,9 +884,12 @@ class Markdown(object):
                 html = text[start_idx:end_idx]
                 if raw and self.safe_mode:
                     html = self._sanitize_html(html)
-                key = _hash_text(html)
+                key = self._placeholder(html)
                 self.html_blocks[key] = html
                 text = text[:start_idx] + "\n\n" + key + "\n\n" + text[end_idx:]
+                # The placeholder is shorter than the comment most of the
+                # time: go on from its end, not from where the comment ended.
+                start = start_idx + len(key) + 4
 
         if "xml" in self.extras:
             # Treat XML processing instructions and namespaced one-liner
@@ -707,31 +904,110 @@ class Markdown(object):
 
         return text
 
+    _block_fence_open_re = re.compile(r"^```[\w+-]*[ \t]*$")
+    _block_fence_close_re = re.compile(r"^```[ \t]*$")
+    _block_list_re = re.compile(r"^[ ]{0,3}(?:[*+-]|\d+\.)[ \t]")
+    _block_empty_item_re = re.compile(r"^[ ]{0,3}(?:[*+-]|\d+\.)[ \t]+$")
+    _block_quote_start_re = re.compile(r"^[ ]{0,3}>")
+    _block_html_re = re.compile(r"^<(%s)\b" % _block_tags_a)
+    _block_strict_end_re = re.compile(r"^</(%s)>[ \t]*$" % _block_tags_a)
+    _block_liberal_end_re = re.compile(r"</(%s)>[ \t]*$" % _block_tags_b)
+
+    def _html_block_ends(self, lines):
+        """Map each block tag to the sorted indexes of the `lines` that can
+        end an HTML block for it, as `_hash_html_blocks` would match them:
+        first the strict (closing tag alone on its line), then the liberal
+        (closing tag at the end of a line) ones.
+        """
+        strict, liberal = {}, {}
+        for i, line in enumerate(lines):
+            if '</' not in line:
+                continue
+            match = self._block_strict_end_re.match(line)
+            if match:
+                strict.setdefault(match.group(1), []).append(i)
+            match = self._block_liberal_end_re.search(line)
+            if match:
+                liberal.setdefault(match.group(1), []).append(i)
+        return strict, liberal
+
+    def _split_blocks(self, text):
+        """Split prepared text into top-level blocks that can be rendered
+        independently of each other.
+
+        A new block only starts after a blank line, on a line that is not
+        indented, and never inside a fenced code block, an HTML block or an
+        HTML comment. Lines that would continue the current list or block
+        quote stay with it, and so does the block after a list item with
+        no text (the list then runs on into it). Each block ends with two
+        newlines, like the whole text does.
+        """
+        from bisect import bisect_left
+        if '</' in text:
+            strict_ends, liberal_ends = self._html_block_ends(_iter_lines(text))
+        else:
+            strict_ends = liberal_ends = {}
+
+        blocks = []
+        lines = []
+        fence = in_list = in_quote = in_comment = empty_item = False
+        html_end = -1
+        for i, line in enumerate(_iter_lines(text)):
+            if not line:
+                if lines:
+                    lines.append(line)
+                continue
+            if (lines and not lines[-1] and line[0] != ' '
+                    and not (fence or in_comment or empty_item) and i > html_end
+                    and not (in_list and self._block_list_re.match(line))
+                    and not (in_quote and self._block_quote_start_re.match(line))):
+                while not lines[-1]:
+                    lines.pop()
+                blocks.append('\n'.join(lines) + '\n\n')
+                lines = []
+                in_list = in_quote = False
+            lines.append(line)
+            empty_item = False
+
+            if i <= html_end:
+                pass
+            elif in_comment:
+                in_comment = "-->" not in line
+            elif fence:
+                fence = not self._block_fence_close_re.match(line)
+            elif (self._block_fence_open_re.match(line)
+                  and (len(lines) == 1 or not lines[-2])):
+                fence = True
+            elif line.startswith("<!--"):
+                in_comment = "-->" not in line
+            else:
+                match = self._block_html_re.match(line)
+                if match:
+                    tag = match.group(1)
+                    ends = strict_ends.get(tag, [])
+                    idx = bisect_left(ends, i + 1)
+                    if idx < len(ends):
+                        html_end = ends[idx]
+                    else:
+                        ends = liberal_ends.get(tag, [])
+                        idx = bisect_left(ends, i)
+                        if idx < len(ends):
+                            html_end = ends[idx]
+                elif self._block_list_re.match(line):
+                    in_list = True
+                    empty_item = bool(self._block_empty_item_re.match(line))
+                elif self._block_quote_start_re.match(line):
+                    in_quote = True
+        while lines and not lines[-1]:
+            lines.pop()
+        if lines:
+            blocks.append('\n'.join(lines) + '\n\n')
+        return blocks
+
     def _strip_link_definitions(self, text):
         # Strips link definitions from text, stores the URLs and titles in
         # hash references.
-        less_than_tab = self.tab_width - 1
-
-        # Link defs are in the form:
-        #   [id]: url "optional title"
-        _link_def_re = re.compile(r"""
-            ^[ ]{0,%d}\[(.+)\]: # id = \1
-              [ \t]*
-              \n?               # maybe *one* newline
-              [ \t]*
-            <?(.+?)>?           # url = \2
-              [ \t]*
-            (?:
-                \n?             # maybe one newline
-                [ \t]*
-                (?<=\s)         # lookbehind for whitespace
-                ['"(]
-                ([^\n]*)        # title = \3
-                ['")]
-                [ \t]*
-            )?  # title is optional
-            (?:\n+|\Z)
-            """ % less_than_tab, re.X | re.M | re.U)
+        _link_def_re = _link_def_re_from_tab_width(self.tab_width)
         return _link_def_re.sub(self._extract_link_def_sub, text)
 
     def _extract_link_def_sub(self, match):
@@ -766,22 +1042,7 @@ class Markdown(object):
             [^note-id]:
                 Text of the note.
         """
-        less_than_tab = self.tab_width - 1
-        footnote_def_re = re.compile(r'''
-            ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
-            [ \t]*
-            (                       # footnote text = \2
-              # First line need not start with the spaces.
-              (?:\s*.*\n+)
-              (?:
-                (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
-                .*\n+
-              )*
-            )
-            # Lookahead for non-space at line-start, or end of doc.
-            (?:(?=^[ ]{0,%d}\S)|\Z)
-            ''' % (less_than_tab, self.tab_width, self.tab_width),
-            re.X | re.M)
+        footnote_def_re = _footnote_def_re_from_tab_width(self.tab_width)
         return footnote_def_re.sub(self._extract_footnote_def_sub, text)
 
 
@@ -854,13 +1115,7 @@ class Markdown(object):
         if ">>>" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        _pyshell_block_re = re.compile(r"""
-            ^([ ]{0,%d})>>>[ ].*\n   # first line
-            ^(\1.*\S+.*\n)*         # any number of subsequent lines
-            ^\n                     # ends with a blank line
-            """ % less_than_tab, re.M | re.X)
-
+        _pyshell_block_re = _pyshell_block_re_from_tab_width(self.tab_width)
         return _pyshell_block_re.sub(self._pyshell_block_sub, text)
 
     def _table_sub(self, match):
@@ -917,29 +1172,7 @@ class Markdown(object):
         """Copying PHP-Markdown and GFM table syntax. Some regex borrowed from
         https://github.com/michelf/php-markdown/blob/lib/Michelf/Markdown.php#L2538
         """
-        less_than_tab = self.tab_width - 1
-        table_re = re.compile(r'''
-                (?:(?<=\n\n)|\A\n?)             # leading blank line
-
-                ^[ ]{0,%d}                      # allowed whitespace
-                (.*[|].*)  \n                   # $1: header row (at least one pipe)
-
-                ^[ ]{0,%d}                      # allowed whitespace
-                (                               # $2: underline row
-                    # underline row with leading bar
-                    (?:  \|\ *:?-+:?\ *  )+  \|?  \n
-                    |
-                    # or, underline row without leading bar
-                    (?:  \ *:?-+:?\ *\|  )+  (?:  \ *:?-+:?\ *  )?  \n
-                )
-
-                (                               # $3: data rows
-                    (?:
-                        ^[ ]{0,%d}(?!\ )         # ensure line begins with 0 to less_than_tab spaces
-                        .*\|.*  \n
-                    )+
-                )
-            ''' % (less_than_tab, less_than_tab, less_than_tab), re.M | re.X)
+        table_re = _table_re_from_tab_width(self.tab_width)
         return table_re.sub(self._table_sub, text)
 
     def _wiki_table_sub(self, match):
@@ -971,14 +1204,12 @@ class Markdown(object):
         if "||" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        wiki_table_re = re.compile(r'''
-            (?:(?<=\n\n)|\A\n?)            # leading blank line
-            ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
-            (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
-            ''' % less_than_tab, re.M | re.X)
+        wiki_table_re = _wiki_table_re_from_tab_width(self.tab_width)
         return wiki_table_re.sub(self._wiki_table_sub, text)
 
+    _break_on_newline_re = re.compile(r" *\n")
+    _hard_break_re = re.compile(r" {2,}\n")
+
     def _run_span_gamut(self, text):
         # These are all the transformations that occur *within* block-level
         # tags like paragraphs, headers, and list items.
@@ -1007,9 +1238,9 @@ class Markdown(object):
 
         # Do hard breaks:
         if "break-on-newline" in self.extras:
-            text = re.sub(r" *\n", "<br%s\n" % self.empty_element_suffix, text)
+            text = self._break_on_newline_re.sub("<br%s\n" % self.empty_element_suffix, text)
         else:
-            text = re.sub(r" {2,}\n", " <br%s\n" % self.empty_element_suffix, text)
+            text = self._hard_break_re.sub(" <br%s\n" % self.empty_element_suffix, text)
 
         return text
 
@@ -1031,6 +1262,16 @@ class Markdown(object):
         )
         """, re.X)
 
+    def _split_html_tokens(self, text):
+        """Splits `text` into alternating text and HTML markup tokens."""
+        # Every token of markup ends in a '>': leave out whatever follows
+        # the last one, instead of having the pattern try (and fail) a
+        # match at each '<' in it.
+        end = text.rfind('>') + 1
+        tokens = self._sorta_html_tokenize_re.split(text[:end])
+        tokens[-1] += text[end:]
+        return tokens
+
     def _escape_special_chars(self, text):
         # Python markdown note: the HTML tokenization here differs from
         # that in Markdown.pl, hence the behaviour for subtle cases can
@@ -1040,7 +1281,7 @@ class Markdown(object):
         # here.
         escaped = []
         is_html_markup = False
-        for token in self._sorta_html_tokenize_re.split(text):
+        for token in self._split_html_tokens(text):
             if is_html_markup:
                 # Within tags/HTML-comments/auto-links, encode * and _
                 # so they don't conflict with their use in Markdown for
@@ -1067,10 +1308,10 @@ class Markdown(object):
 
         tokens = []
         is_html_markup = False
-        for token in self._sorta_html_tokenize_re.split(text):
+        for token in self._split_html_tokens(text):
             if is_html_markup and not _is_auto_link(token):
                 sanitized = self._sanitize_html(token)
-                key = _hash_text(sanitized)
+                key = self._placeholder(sanitized)
                 self.html_spans[key] = sanitized
                 tokens.append(key)
             else:
@@ -1078,11 +1319,6 @@ class Markdown(object):
             is_html_markup = not is_html_markup
         return ''.join(tokens)
 
-    def _unhash_html_spans(self, text):
-        for key, sanitized in list(self.html_spans.items()):
-            text = text.replace(key, sanitized)
-        return text
-
     def _sanitize_html(self, s):
         if self.safe_mode == "replace":
             return self.html_removed_text
@@ -1133,16 +1369,14 @@ class Markdown(object):
         out - the same number of open_c and close_c are encountered - or the
         end of string if it's reached before the balance point is found.
         """
-        i = start
-        l = len(text)
-        count = 1
-        while count > 0 and i < l:
-            if text[i] == open_c:
-                count += 1
-            elif text[i] == close_c:
-                count -= 1
-            i += 1
-        return i
+        index = self._balance_indexes.get(open_c)
+        if index is None or index.text is not text:
+            index = self._balance_indexes[open_c] = \
+                _BalanceIndex(text, open_c, close_c)
+        end = index.find(start)
+        if end is None:
+            return len(text)
+        return end
 
     def _extract_url_and_title(self, text, start):
         """Extracts the url and (optional) title from the tail of a link"""
@@ -1155,6 +1389,10 @@ class Markdown(object):
         if has_anglebrackets:
             end_idx = self._find_balanced(text, end_idx+1, "<", ">")
         end_idx = self._find_balanced(text, end_idx, "(", ")")
+        if not text.endswith(")", idx, end_idx):
+            # Not a link. Check before searching: unbalanced parens put
+            # `end_idx` at the end of the text.
+            return None, None, None
         match = self._inline_link_title.search(text, idx, end_idx)
         if not match:
             return None, None, None
@@ -1163,7 +1401,7 @@ class Markdown(object):
             url = self._strip_anglebrackets.sub(r'\1', url)
         return url, title, end_idx
 
-    def _do_links(self, text):
+    def _do_links(self, text, in_anchor=False):
         """Turn Markdown link shortcuts into XHTML <a> and <img> tags.
 
         This is a combination of Markdown.pl's _DoAnchors() and
@@ -1171,14 +1409,19 @@ class Markdown(object):
         approach. It was necessary to use a different approach than
         Markdown.pl because of the lack of atomic matching support in
         Python's regex engine used in $g_nested_brackets.
+
+        The result is built in a single pass over `text`. The text of an
+        anchor is processed on its own, with `in_anchor` set: it may hold
+        images but no other anchors.
         """
         MAX_LINK_TEXT_SENTINEL = 3000  # markdown2 issue 24
 
-        # `anchor_allowed_pos` is used to support img links inside
-        # anchors, but not anchors inside anchors. An anchor's start
-        # pos must be `>= anchor_allowed_pos`.
-        anchor_allowed_pos = 0
-
+        if '[' not in text:
+            return text
+        brackets = _BalanceIndex(text, "[", "]")
+        text_length = len(text)
+        pieces = []
+        emitted = 0  # `text[:emitted]` is already in `pieces`
         curr_pos = 0
         while True: # Handle the next link.
             # The next '[' is the start of:
@@ -1196,32 +1439,23 @@ class Markdown(object):
             #   These have already been stripped in
             #   _strip_link_definitions() so no need to watch for them.
             # - not markup:         [...anything else...
-            try:
-                start_idx = text.index('[', curr_pos)
-            except ValueError:
+            start_idx = text.find('[', curr_pos)
+            if start_idx == -1:
                 break
-            text_length = len(text)
 
             # Find the matching closing ']'.
             # Markdown.pl allows *matching* brackets in link text so we
             # will here too. Markdown.pl *doesn't* currently allow
             # matching brackets in img alt text -- we'll differ in that
             # regard.
-            bracket_depth = 0
-            for p in range(start_idx+1, min(start_idx+MAX_LINK_TEXT_SENTINEL,
-                                            text_length)):
-                ch = text[p]
-                if ch == ']':
-                    bracket_depth -= 1
-                    if bracket_depth < 0:
-                        break
-                elif ch == '[':
-                    bracket_depth += 1
-            else:
+            p = brackets.find(start_idx+1)
+            if p is None or p > min(start_idx+MAX_LINK_TEXT_SENTINEL,
+                                    text_length):
                 # Closing bracket not found within sentinel length.
                 # This isn't markup.
                 curr_pos = start_idx + 1
                 continue
+            p -= 1
             link_text = text[start_idx+1:p]
 
             # Possibly a footnote ref?
@@ -1234,7 +1468,9 @@ class Markdown(object):
                     #          % (normed_id, normed_id, len(self.footnote_ids))
                     result = '<sup title="%s"%s>%s</sup>' \
                              % (normed_id, self._html_class_str_from_tag("sup"), len(self.footnote_ids))
-                    text = text[:start_idx] + result + text[p+1:]
+                    pieces.append(text[emitted:start_idx])
+                    pieces.append(result)
+                    emitted = curr_pos = p+1
                 else:
                     # This id isn't defined, leave the markup alone.
                     curr_pos = p+1
@@ -1243,14 +1479,14 @@ class Markdown(object):
             # Now determine what this is by the remainder.
             p += 1
             if p == text_length:
-                return text
+                break
 
             # Inline anchor or img?
             if text[p] == '(': # attempt at perf improvement
                 url, title, url_end_idx = self._extract_url_and_title(text, p)
                 if url is not None:
                     # Handle an inline anchor or img.
-                    is_img = start_idx > 0 and text[start_idx-1] == "!"
+                    is_img = start_idx > emitted and text[start_idx-1] == "!"
                     if is_img:
                         start_idx -= 1
 
@@ -1273,18 +1509,14 @@ class Markdown(object):
                                title_str, img_class_str, self.empty_element_suffix)
                         if "smarty-pants" in self.extras:
                             result = result.replace('"', self._escape_table['"'])
-                        curr_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
-                    elif start_idx >= anchor_allowed_pos:
-                        result_head = '<a href="%s"%s>' % (url, title_str)
-                        result = '%s%s</a>' % (result_head, link_text)
-                        if "smarty-pants" in self.extras:
-                            result = result.replace('"', self._escape_table['"'])
-                        # <img> allowed from curr_pos on, <a> from
-                        # anchor_allowed_pos on.
-                        curr_pos = start_idx + len(result_head)
-                        anchor_allowed_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
+                        pieces.append(text[emitted:start_idx])
+                        pieces.append(result)
+                        emitted = curr_pos = url_end_idx
+                    elif not in_anchor:
+                        pieces.append(text[emitted:start_idx])
+                        pieces.extend(self._anchor_pieces(
+                            '<a href="%s"%s>' % (url, title_str), link_text))
+                        emitted = curr_pos = url_end_idx
                     else:
                         # Anchor not allowed here.
                         curr_pos = start_idx + 1
@@ -1295,7 +1527,7 @@ class Markdown(object):
                 match = self._tail_of_reference_link_re.match(text, p)
                 if match:
                     # Handle a reference-style anchor or img.
-                    is_img = start_idx > 0 and text[start_idx-1] == "!"
+                    is_img = start_idx > emitted and text[start_idx-1] == "!"
                     if is_img:
                         start_idx -= 1
                     link_id = match.group("id").lower()
@@ -1309,7 +1541,6 @@ class Markdown(object):
                                  .replace('_', self._escape_table['_'])
                         title = self.titles.get(link_id)
                         if title:
-                            before = title
                             title = _xml_escape_attr(title) \
                                 .replace('*', self._escape_table['*']) \
                                 .replace('_', self._escape_table['_'])
@@ -1324,20 +1555,14 @@ class Markdown(object):
                                    title_str, img_class_str, self.empty_element_suffix)
                             if "smarty-pants" in self.extras:
                                 result = result.replace('"', self._escape_table['"'])
-                            curr_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
-                        elif start_idx >= anchor_allowed_pos:
-                            result = '<a href="%s"%s>%s</a>' \
-                                % (url, title_str, link_text)
-                            result_head = '<a href="%s"%s>' % (url, title_str)
-                            result = '%s%s</a>' % (result_head, link_text)
-                            if "smarty-pants" in self.extras:
-                                result = result.replace('"', self._escape_table['"'])
-                            # <img> allowed from curr_pos on, <a> from
-                            # anchor_allowed_pos on.
-                            curr_pos = start_idx + len(result_head)
-                            anchor_allowed_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
+                            pieces.append(text[emitted:start_idx])
+                            pieces.append(result)
+                            emitted = curr_pos = match.end()
+                        elif not in_anchor:
+                            pieces.append(text[emitted:start_idx])
+                            pieces.extend(self._anchor_pieces(
+                                '<a href="%s"%s>' % (url, title_str), link_text))
+                            emitted = curr_pos = match.end()
                         else:
                             # Anchor not allowed here.
                             curr_pos = start_idx + 1
@@ -1349,7 +1574,17 @@ class Markdown(object):
             # Otherwise, it isn't markup.
             curr_pos = start_idx + 1
 
-        return text
+        pieces.append(text[emitted:])
+        return ''.join(pieces)
+
+    def _anchor_pieces(self, result_head, link_text):
+        """The pieces of an <a> tag around `link_text`, in which images
+        (but not other anchors) are still processed.
+        """
+        if "smarty-pants" in self.extras:
+            result_head = result_head.replace('"', self._escape_table['"'])
+            link_text = link_text.replace('"', self._escape_table['"'])
+        return [result_head, self._do_links(link_text, in_anchor=True), '</a>']
 
     def header_id_from_text(self, text, prefix, n):
         """Generate a header id attribute value from the given header
@@ -1456,53 +1691,32 @@ class Markdown(object):
     def _do_lists(self, text):
         # Form HTML ordered (numbered) and unordered (bulleted) lists.
 
-        # Iterate over each *non-overlapping* list match.
+        # Iterate over each *non-overlapping* list match. We match ul and
+        # ol separately to avoid adjacent lists of different types running
+        # into each other (see issue #16). The next hit for each list style
+        # is kept until the lists before it are done: searching again for
+        # both after every list would be quadratic in the number of lists.
+        list_res = [_list_re_from_tab_width(self.tab_width, marker_pat,
+                                            bool(self.list_level))
+                    for marker_pat in (self._marker_ul, self._marker_ol)]
+        next_hits = [list_re.search(text) for list_re in list_res]
+        pieces = []
         pos = 0
         while True:
-            # Find the *first* hit for either list style (ul or ol). We
-            # match ul and ol separately to avoid adjacent lists of different
-            # types running into each other (see issue #16).
-            hits = []
-            for marker_pat in (self._marker_ul, self._marker_ol):
-                less_than_tab = self.tab_width - 1
-                whole_list = r'''
-                    (                   # \1 = whole list
-                      (                 # \2
-                        [ ]{0,%d}
-                        (%s)            # \3 = first list item marker
-                        [ \t]+
-                        (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
-                      )
-                      (?:.+?)
-                      (                 # \4
-                          \Z
-                        |
-                          \n{2,}
-                          (?=\S)
-                          (?!           # Negative lookahead for another list item marker
-                            [ \t]*
-                            %s[ \t]+
-                          )
-                      )
-                    )
-                ''' % (less_than_tab, marker_pat, marker_pat)
-                if self.list_level:  # sub-list
-                    list_re = re.compile("^"+whole_list, re.X | re.M | re.S)
-                else:
-                    list_re = re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
-                                         re.X | re.M | re.S)
-                match = list_re.search(text, pos)
-                if match:
-                    hits.append((match.start(), match))
+            # Find the *first* hit for either list style (ul or ol).
+            for i, list_re in enumerate(list_res):
+                if next_hits[i] is not None and next_hits[i].start() < pos:
+                    next_hits[i] = list_re.search(text, pos)
+            hits = [m for m in next_hits if m is not None]
             if not hits:
                 break
-            hits.sort()
-            match = hits[0][1]
-            start, end = match.span()
-            text = text[:start] + self._list_sub(match) + text[end:]
-            pos = end
+            match = min(hits, key=lambda m: m.start())
+            pieces.append(text[pos:match.start()])
+            pieces.append(self._list_sub(match))
+            pos = match.end()
 
-        return text
+        pieces.append(text[pos:])
+        return ''.join(pieces)
 
     _list_item_re = re.compile(r'''
         (\n)?                   # leading line = \1
@@ -1569,48 +1783,34 @@ class Markdown(object):
         return list_str
 
     def _get_pygments_lexer(self, lexer_name):
-        try:
-            from pygments import lexers, util
-        except ImportError:
-            return None
-        try:
-            return lexers.get_lexer_by_name(lexer_name)
-        except util.ClassNotFound:
-            return None
+        return _pygments_lexer_from_name(lexer_name)
 
     def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
         import pygments
-        import pygments.formatters
 
         pre_class_str = self._html_class_str_from_tag("pre")
         code_class_str = self._html_class_str_from_tag("code")
-
-        class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
-            def _wrap_code(self, inner):
-                """A function for use in a Pygments Formatter which
-                wraps in <code> tags.
-                """
-                pre_style = pre_class_str
-                lang_code = ""
-                if hasattr(lexer, 'orig_name'):
-                    lang_code = ' title="%s"' % lexer.orig_name
-                if self.style.background_color and pre_style.startswith(' style'):
-                    pre_style = pre_style[0:-1] + 'background-color:' + self.style.background_color + ';"'
-                yield 0, "<pre%s%s>" % (lang_code, pre_style)
-                yield 0, "<code%s>" % code_class_str
-                for tup in inner:
-                    yield tup
-                yield 0, "</code>"
-                yield 0, "</pre>"
-
-            def wrap(self, source, outfile):
-                """Return the source with a code, pre, and div."""
-                # return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
-                return self._wrap_code(source)
+        lang_code = ""
+        if hasattr(lexer, 'orig_name'):
+            lang_code = ' title="%s"' % lexer.orig_name
 
         formatter_opts.setdefault("cssclass", "codehilite")
-        formatter = HtmlCodeFormatter(**formatter_opts)
-        return pygments.highlight(codeblock, lexer, formatter)
+        formatter_key = (lang_code, pre_class_str, code_class_str,
+                         repr(sorted(formatter_opts.items())))
+        key = formatter_key + (type(lexer).__name__,
+            md5(codeblock.encode("utf-8")).hexdigest())
+        colored = _pygments_highlight_cache.get(key)
+        if colored is None:
+            formatter = _pygments_formatter_cache.get(formatter_key)
+            if formatter is None:
+                formatter = _html_code_formatter_class()(**formatter_opts)
+                formatter.lang_code = lang_code
+                formatter.pre_class_str = pre_class_str
+                formatter.code_class_str = code_class_str
+                _pygments_formatter_cache.put(formatter_key, formatter)
+            colored = pygments.highlight(codeblock, lexer, formatter)
+            _pygments_highlight_cache.put(key, colored)
+        return colored
 
     def _code_block_sub(self, match, is_fenced_code_block=False):
         lexer_name = None
@@ -1648,40 +1848,34 @@ class Markdown(object):
         return "\n\n<pre%s><code%s>%s\n</code></pre>\n\n" % (
             pre_class_str, code_class_str, codeblock)
 
+    def _tag_attrs_from_extras(self, extras):
+        """Build the table of the ' style="..."' or ' class="..."' strings
+        (note the leading space) to add to each tag, from the "inline-css"
+        and "html-classes" extras. Inline CSS wins over classes.
+
+        The keys are the tag names and the pseudo-tags the markdowner asks
+        for, e.g. "tr:odd", "tr:even", "inline-code" or "footnotes".
+        """
+        attrs = {}
+        html_classes_from_tag = extras.get("html-classes")
+        if isinstance(html_classes_from_tag, dict):
+            for tag, classes in html_classes_from_tag.items():
+                attrs[tag] = ' class="%s"' % classes
+        css_from_tag = extras.get("inline-css")
+        if isinstance(css_from_tag, dict):
+            for tag, css in css_from_tag.items():
+                attrs[tag] = ' style="%s"' % css
+        return attrs
+
     def _html_class_str_from_tag(self, tag):
         """Get the appropriate ' class="..."' string (note the leading
         space), if any, for the given tag.
         """
-        if "inline-css" in self.extras:
-            css_from_tag = self.extras.get("inline-css", {})
-            if tag in css_from_tag:
-                return ' style="%s"' % css_from_tag[tag]
-        if "html-classes" in self.extras:
-            try:
-                html_classes_from_tag = self.extras["html-classes"]
-            except TypeError:
-                return ""
-            else:
-                if tag in html_classes_from_tag:
-                    return ' class="%s"' % html_classes_from_tag[tag]
-        return ""
+        return self._tag_attrs.get(tag, "")
 
     def _do_code_blocks(self, text):
         """Process Markdown `<pre><code>` blocks."""
-        code_block_re = re.compile(r'''
-            (?:\n\n|\A\n?)
-            (               # $1 = the code block -- one or more lines, starting with a space/tab
-              (?:
-                (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
-                .*\n+
-              )+
-            )
-            ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
-            # Lookahead to make sure this block isn't already in a code block.
-            # Needed when syntax highlighting is being used.
-            (?![^<]*\</code\>)
-            ''' % (self.tab_width, self.tab_width),
-            re.M | re.X)
+        code_block_re = _code_block_re_from_tab_width(self.tab_width)
         return code_block_re.sub(self._code_block_sub, text)
 
     _fenced_code_block_re = re.compile(r'''
@@ -1761,9 +1955,7 @@ class Markdown(object):
         ]
         for before, after in replacements:
             text = text.replace(before, after)
-        hashed = _hash_text(text)
-        self._escape_table[text] = hashed
-        return hashed
+        return self._placeholder(text)
 
     _strong_re = re.compile(r"(\*\*|__)(?=\S)(.+?[*_]*)(?<=\S)\1", re.S)
     _em_re = re.compile(r"(\*|_)(?=\S)(.+?)(?<=\S)\1", re.S)
@@ -1771,19 +1963,46 @@ class Markdown(object):
     _underline_re = re.compile(r"==(?=\S)(.+?)(?<=\S)==", re.S)
     _code_friendly_strong_re = re.compile(r"\*\*(?=\S)(.+?[*_]*)(?<=\S)\*\*", re.S)
     _code_friendly_em_re = re.compile(r"\*(?=\S)(.+?)(?<=\S)\*", re.S)
+    # Where the spans above can open and close, for _sub_with_closers().
+    _strong_open_re = re.compile(r"(\*\*|__)(?=\S)")
+    _strong_close_re = re.compile(r"\S(?=(\*\*|__))")
+    _em_open_re = re.compile(r"([*_])(?=\S)")
+    _em_close_re = re.compile(r"\S(?=([*_]))")
+    _strike_open_re = re.compile(r"(~~)(?=\S)")
+    _strike_close_re = re.compile(r"\S(?=(~~))")
+    _underline_open_re = re.compile(r"(==)(?=\S)")
+    _underline_close_re = re.compile(r"\S(?=(==))")
+    _code_friendly_strong_open_re = re.compile(r"(\*\*)(?=\S)")
+    _code_friendly_strong_close_re = re.compile(r"\S(?=(\*\*))")
+    _code_friendly_em_open_re = re.compile(r"(\*)(?=\S)")
+    _code_friendly_em_close_re = re.compile(r"\S(?=(\*))")
     def _do_italics_and_bold(self, text):
+        # A plain re.sub() with the patterns above goes quadratic on many
+        # unclosed markers (e.g. "*a *b *c ..."), so only try to match
+        # where a closing marker follows.
         # <strong> must go first:
         if "code-friendly" in self.extras:
-            text = self._code_friendly_strong_re.sub(r"<strong>\1</strong>", text)
-            text = self._code_friendly_em_re.sub(r"<em>\1</em>", text)
+            text = _sub_with_closers(self._code_friendly_strong_re,
+                r"<strong>\1</strong>", text,
+                self._code_friendly_strong_open_re,
+                self._code_friendly_strong_close_re, 1)
+            text = _sub_with_closers(self._code_friendly_em_re,
+                r"<em>\1</em>", text,
+                self._code_friendly_em_open_re,
+                self._code_friendly_em_close_re, 1)
         else:
-            text = self._strong_re.sub(r"<strong>\2</strong>", text)
-            text = self._em_re.sub(r"<em>\2</em>", text)
+            text = _sub_with_closers(self._strong_re,
+                r"<strong>\2</strong>", text,
+                self._strong_open_re, self._strong_close_re, 1)
+            text = _sub_with_closers(self._em_re, r"<em>\2</em>", text,
+                self._em_open_re, self._em_close_re, 1)
         # text = self._strike_re.sub(r"<del>\1</del>", text)  # GFM way
         # text = self._strike_re.sub(r'<span style="text-decoration: line-through;">\1</span>', text)  # Evernote way
         # text = self._underline_re.sub(r'<span style="text-decoration: underline;">\1</span>', text)  # Evernote way
-        text = self._strike_re.sub(r'<strike>\1</strike>', text)
-        text = self._underline_re.sub(r'<u>\1</u>', text)
+        text = _sub_with_closers(self._strike_re, r'<strike>\1</strike>', text,
+            self._strike_open_re, self._strike_close_re, 1)
+        text = _sub_with_closers(self._underline_re, r'<u>\1</u>', text,
+            self._underline_open_re, self._underline_close_re, 1)
         return text
 
     # "smarty-pants" extra: Very liberal in interpreting a single prime as an
@@ -1866,13 +2085,15 @@ class Markdown(object):
             return text
         return self._block_quote_re.sub(self._block_quote_sub, text)
 
+    _graf_split_re = re.compile(r"\n{2,}")
+
     def _form_paragraphs(self, text):
         # Strip leading and trailing lines:
         text = text.strip('\n')
 
         # Wrap <p> tags.
         grafs = []
-        for i, graf in enumerate(re.split(r"\n{2,}", text)):
+        for i, graf in enumerate(self._graf_split_re.split(text)):
             if graf in self.html_blocks:
                 # Unhashify HTML blocks
                 grafs.append(self.html_blocks[graf])
@@ -1939,8 +2160,10 @@ class Markdown(object):
     # Ampersand-encoding based entirely on Nat Irons's Amputator MT plugin:
     #   http://bumppo.net/projects/amputator/
     _ampersand_re = re.compile(r'&(?!#?[xX]?(?:[0-9a-fA-F]+|\w+);)')
-    _naked_lt_re = re.compile(r'<(?![a-z/?\$!])', re.I)
-    _naked_gt_re = re.compile(r'''(?<![a-z0-9?!/'"-])>''', re.I)
+    # A placeholder next to an angle bracket leaves it alone, like the tag
+    # name or attribute a placeholder can stand in for.
+    _naked_lt_re = re.compile(r'<(?![a-z/?\$!\x02])', re.I)
+    _naked_gt_re = re.compile(r'''(?<![a-z0-9?!/'"\x03-])>''', re.I)
 
     def _encode_amps_and_angles(self, text):
         # Smart processing for ampersands and angle brackets that need
@@ -1957,6 +2180,8 @@ class Markdown(object):
         return text
 
     def _encode_backslash_escapes(self, text):
+        if "\\" not in text:
+            return text
         for ch, escape in list(self._escape_table.items()):
             text = text.replace("\\"+ch, escape)
         return text
@@ -2012,34 +2237,83 @@ class Markdown(object):
 
         Dev Notes: *Could* consider prefixing regexes with a negative
         lookbehind assertion to attempt to guard against this.
+
+        Every pattern is matched against the same text and the links are
+        put in with a single join. Where matches overlap, the pattern
+        earlier in `self.link_patterns` wins, then the earlier match.
+        Matches overlapping a placeholder are dropped, as they would
+        break it.
         """
-        link_from_hash = {}
+        from bisect import bisect
+        starts, ends, hrefs = [], [], []
+        if "\x02" in text:
+            for match in _placeholder_re.finditer(text):
+                starts.append(match.start())
+                ends.append(match.end())
+                hrefs.append(None)
         for regex, repl in self.link_patterns:
-            replacements = []
+            href_from_groups = {}
             for match in regex.finditer(text):
+                start, end = match.span()
+                i = bisect(starts, start)
+                if (i and ends[i-1] > start) \
+                   or (i < len(starts) and starts[i] < end):
+                    continue    # overlaps a link already made
                 if hasattr(repl, "__call__"):
                     href = repl(match)
                 else:
-                    href = match.expand(repl)
-                replacements.append((match.span(), href))
-            for (start, end), href in reversed(replacements):
-                escaped_href = (
-                    href.replace('"', '&quot;')  # b/c of attr quote
-                        # To avoid markdown <em> and <strong>:
-                        .replace('*', self._escape_table['*'])
-                        .replace('_', self._escape_table['_']))
-                link = '<a href="%s">%s</a>' % (escaped_href, text[start:end])
-                hash = _hash_text(link)
-                link_from_hash[hash] = link
-                text = text[:start] + hash + text[end:]
-        for hash, link in list(link_from_hash.items()):
-            text = text.replace(hash, link)
-        return text
+                    # The same reference tends to come up many times, and
+                    # expanding a template means parsing it again.
+                    groups = (match.group(),) + match.groups()
+                    href = href_from_groups.get(groups)
+                    if href is None:
+                        href = href_from_groups[groups] = match.expand(repl)
+                starts.insert(i, start)
+                ends.insert(i, end)
+                hrefs.insert(i, href)
+        if not starts:
+            return text
+
+        pieces = []
+        pos = 0
+        for start, end, href in zip(starts, ends, hrefs):
+            if href is None:
+                continue    # a placeholder, left as it is
+            escaped_href = (
+                href.replace('"', '&quot;')  # b/c of attr quote
+                    # To avoid markdown <em> and <strong>:
+                    .replace('*', self._escape_table['*'])
+                    .replace('_', self._escape_table['_']))
+            pieces.append(text[pos:start])
+            pieces.append('<a href="%s">%s</a>' % (escaped_href, text[start:end]))
+            pos = end
+        pieces.append(text[pos:])
+        return ''.join(pieces)
+
+    def _reset_placeholders(self):
+        self._placeholders = list(self._base_placeholders)
+        self._placeholder_from_text = self._escape_table.copy()
+
+    def _placeholder(self, text):
+        """Returns the placeholder standing in for `text` until
+        _unescape_special_chars() puts it back.
+        """
+        placeholder = self._placeholder_from_text.get(text)
+        if placeholder is None:
+            placeholder = _placeholder_fmt % len(self._placeholders)
+            self._placeholder_from_text[text] = placeholder
+            self._placeholders.append(text)
+        return placeholder
+
+    def _placeholder_sub(self, match):
+        return self._placeholders[int(match.group(1))]
 
     def _unescape_special_chars(self, text):
-        # Swap back in all the special characters we've hidden.
-        for ch, hash in list(self._escape_table.items()):
-            text = text.replace(hash, ch)
+        # Swap back in all the special characters, code and HTML we've
+        # hidden: in one pass, plus one for each level they nest.
+        n = 1
+        while n:
+            text, n = _placeholder_re.subn(self._placeholder_sub, text)
         return text
 
     def _outdent(self, text):
@@ -2062,6 +2336,141 @@ class MarkdownWithExtras(Markdown):
     extras = ["footnotes", "code-color"]
 
 
+class IncrementalMarkdown(Markdown):
+    """A markdowner class meant to be kept around and fed successive
+    revisions of the same document (e.g. a buffer that is saved over and
+    over again).
+
+    Code, raw HTML and link and footnote definitions are taken out of the
+    whole text as in the full conversion. What is left is split into
+    top-level blocks (paragraphs, headers, whole lists, block quotes, ...)
+    and the HTML rendered for each block is kept in a bounded LRU cache,
+    so only the blocks that changed since the last conversion are
+    rendered again: a block that refers to link definitions or footnotes
+    is re-rendered when a definition changes or when the number of the
+    footnotes before it changes. The HTML is the one `convert` returns.
+
+    The "header-ids" and "toc" extras number headers across the whole
+    document, the full conversion numbers footnotes pass by pass, and the
+    safe mode and file variables can change the rendering of any block, so
+    conversions using those, footnotes from more than one block or
+    block-level HTML tags left open (or closed) across blocks are rendered
+    in one piece.
+
+    The code and HTML that the cached blocks refer to are kept across
+    conversions as well, until they add up to more than
+    `max_placeholder_size` characters: both are then dropped.
+    """
+    def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
+                 extras=None, link_patterns=None, use_file_vars=False,
+                 cache_size=4096, max_placeholder_size=8 * 1024 * 1024):
+        Markdown.__init__(self, html4tags=html4tags, tab_width=tab_width,
+                          safe_mode=safe_mode, extras=extras,
+                          link_patterns=link_patterns,
+                          use_file_vars=use_file_vars)
+        self._block_cache = _LRUCache(cache_size)
+        self._max_placeholders = 16 * cache_size
+        self._max_placeholder_size = max_placeholder_size
+        self._placeholder_size = 0
+
+    def _reset_placeholders(self):
+        # The cached blocks refer to placeholders by number, so keep them
+        # across conversions. Start over, with an empty cache, once there
+        # are too many or they stand for too much text: each edit of a
+        # code or HTML block adds a copy of it.
+        if self._placeholders is None \
+           or len(self._placeholders) > self._max_placeholders \
+           or self._placeholder_size > self._max_placeholder_size:
+            Markdown._reset_placeholders(self)
+            self._block_cache.clear()
+            self._placeholder_size = 0
+
+    def _placeholder(self, text):
+        count = len(self._placeholders)
+        placeholder = Markdown._placeholder(self, text)
+        if len(self._placeholders) > count:
+            self._placeholder_size += len(text)
+        return placeholder
+
+    def _render_block(self, text, defs_key):
+        """Run the block gamut on one stripped block, reusing the cached
+        HTML if neither the block nor anything it refers to changed.
+        """
+        footnote_ids = self.footnote_ids
+        key = ("html", text,
+               defs_key if '[' in text else None,
+               len(footnote_ids) if footnote_ids is not None and '[^' in text else None)
+        entry = self._block_cache.get(key)
+        if entry is not None:
+            html, ids = entry
+            if ids:
+                footnote_ids.extend(ids)
+            return html
+
+        start = len(footnote_ids) if footnote_ids is not None else 0
+        html = self._run_block_gamut(text)
+        ids = footnote_ids[start:] if footnote_ids is not None else []
+        self._block_cache.put(key, (html, ids))
+        return html
+
+    _block_tag_re = re.compile(r"<(/?)(%s)\b" % Markdown._block_tags_a)
+
+    def _balanced_html(self, block):
+        """Whether every block-level tag opened in `block` is closed in it
+        and the other way round.
+        """
+        if '<' not in block:
+            return True
+        counts = {}
+        for slash, tag in self._block_tag_re.findall(block):
+            counts[tag] = counts.get(tag, 0) + (-1 if slash else 1)
+        return not any(counts.values())
+
+    def _comment_scan_stops(self, blocks):
+        """Whether a comment that does not start its block comes before a
+        comment in a later block: `_hash_html_blocks` stops looking for
+        standalone comments at the first one not after a blank line.
+        """
+        for i, block in enumerate(blocks):
+            if "<!--" in block.lstrip(" ")[1:]:
+                return any("<!--" in later for later in blocks[i+1:])
+        return False
+
+    def _leading_comment(self, text, blocks):
+        """Whether `text` starts with a single newline and a comment, which
+        `_hash_html_blocks` hashes with the newline.
+        """
+        return (text[:1] == "\n" and text[1:2] != "\n"
+                and blocks[0].lstrip(" ").startswith("<!--"))
+
+    def _render_body(self, text):
+        if (self.safe_mode or self.use_file_vars
+                or "header-ids" in self.extras):
+            return Markdown._render_body(self, text)
+
+        text = self._strip(text)
+        blocks = [block for block in self._split_blocks(text) if block.strip()]
+        if len(blocks) < 2 or (self.footnotes
+                               and sum('[^' in block for block in blocks) > 1):
+            # The full conversion numbers footnotes pass by pass (the ones
+            # in headers and lists before those in paragraphs), not block
+            # by block.
+            return self._run_block_gamut(text)
+        if (not all(self._balanced_html(block) for block in blocks)
+                or self._comment_scan_stops(blocks)
+                or self._leading_comment(text, blocks)):
+            # HTML blocks are hashed after the lists and block quotes
+            # are done, so a stray tag can end up pairing with one in
+            # another block, and a comment can decide whether the ones
+            # in the next blocks are hashed.
+            return self._run_block_gamut(text)
+        defs_key = _hash_text(repr((sorted(self.urls.items()),
+                                    sorted(self.titles.items()),
+                                    sorted((self.footnotes or {}).items()))))
+        htmls = [self._render_block(block, defs_key) for block in blocks]
+        return "\n\n".join(htmls)
+
+
 #---- internal support functions
 
 class UnicodeWithAttrs(unicode):
@@ -2070,6 +2479,7 @@ class UnicodeWithAttrs(unicode):
     the "toc" extra is used.
     """
     metadata = None
+    elapsed = None
     _toc = None
     def toc_html(self):
         """Return the HTML for the current TOC.
@@ -2247,6 +2657,121 @@ def _dedent(text, tabsize=8, skip_first_line=False):
     return ''.join(lines)
 
 
+class _LRUCache(object):
+    """A dict-like cache holding at most `max_size` entries, dropping the
+    least recently used ones first. Safe to share between threads.
+    """
+    def __init__(self, max_size):
+        from collections import OrderedDict
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    def __len__(self):
+        return len(self._data)
+
+
+class _BalanceIndex(object):
+    """Where the `open_c` ... `close_c` pairs in `text` balance out.
+
+    Built in one pass over the text, so that finding the balance point for
+    every bracket in a document stays linear instead of rescanning the rest
+    of the text from each opening bracket.
+    """
+    def __init__(self, text, open_c, close_c):
+        self.text = text
+        self._positions = []    # every open_c and close_c, in order
+        self._depths = [0]      # the nesting depth before each of those
+        self._closes = {}       # depth -> the close_c positions falling to it
+        depth = 0
+        pattern = re.escape(open_c) + '|' + re.escape(close_c)
+        for match in re.finditer(pattern, text):
+            if match.group() == open_c:
+                depth += 1
+            else:
+                depth -= 1
+                self._closes.setdefault(depth, []).append(match.start())
+            self._positions.append(match.start())
+            self._depths.append(depth)
+
+    def find(self, start):
+        """Returns the index just past the close_c that balances an open_c
+        right before `start`, or None if the text ends first.
+        """
+        from bisect import bisect_left
+        depth = self._depths[bisect_left(self._positions, start)]
+        closes = self._closes.get(depth - 1, ())
+        i = bisect_left(closes, start)
+        if i == len(closes):
+            return None
+        return closes[i] + 1
+
+
+def _iter_lines(text):
+    """Generate the lines of `text` like `text.split('\n')` does, without
+    building the list: for a large text it takes several times the memory
+    of the text itself.
+    """
+    start = 0
+    while True:
+        end = text.find('\n', start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+def _sub_with_closers(regex, repl, text, opener_re, closer_re, min_gap=0):
+    """Returns `regex.sub(repl, text)`, for a `regex` matching from an
+    `opener_re` match up to the end of a `closer_re` match with the same
+    group 1, at least `min_gap` characters after the opener.
+
+    An opener with no closer after it is skipped straight away. `regex`
+    itself would scan to the end of the text before failing there, which
+    makes a plain `regex.sub` quadratic in the number of unclosed openers.
+    """
+    opener = opener_re.search(text)
+    if opener is None:
+        return text
+    last_closers = {}
+    for match in closer_re.finditer(text, opener.end()):
+        last_closers[match.group(1)] = match.end()
+    if not last_closers:
+        return text
+    pieces = []
+    emitted = 0
+    while opener is not None:
+        last_closer = last_closers.get(opener.group(1))
+        match = None
+        if last_closer is not None and last_closer >= opener.end() + min_gap:
+            match = regex.match(text, opener.start())
+        if match is None:
+            opener = opener_re.search(text, opener.start() + 1)
+            continue
+        pieces.append(text[emitted:match.start()])
+        pieces.append(repl(match) if callable(repl) else match.expand(repl))
+        emitted = match.end()
+        opener = opener_re.search(text, emitted)
+    pieces.append(text[emitted:])
+    return ''.join(pieces)
+
+
 class _memoized(object):
    """Decorator that caches a function's return value each time it is called.
    If called later with the same arguments, the cached value is returned, and
@@ -2272,6 +2797,56 @@ class _memoized(object):
       return self.func.__doc__
 
 
+def _pygments_lexer_from_name(lexer_name):
+    """The pygments lexer for the given name, or None."""
+    try:
+        from pygments import lexers, util
+    except ImportError:
+        return None
+    try:
+        return lexers.get_lexer_by_name(lexer_name)
+    except util.ClassNotFound:
+        return None
+_pygments_lexer_from_name = _memoized(_pygments_lexer_from_name)
+
+def _html_code_formatter_class():
+    """A pygments formatter wrapping the highlighted code in <pre> and
+    <code> tags. Instances are given `lang_code`, `pre_class_str` and
+    `code_class_str` attributes after construction.
+    """
+    import pygments.formatters
+
+    class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
+        lang_code = pre_class_str = code_class_str = ""
+
+        def _wrap_code(self, inner):
+            """A function for use in a Pygments Formatter which
+            wraps in <code> tags.
+            """
+            pre_style = self.pre_class_str
+            if self.style.background_color and pre_style.startswith(' style'):
+                pre_style = pre_style[0:-1] + 'background-color:' + self.style.background_color + ';"'
+            yield 0, "<pre%s%s>" % (self.lang_code, pre_style)
+            yield 0, "<code%s>" % self.code_class_str
+            for tup in inner:
+                yield tup
+            yield 0, "</code>"
+            yield 0, "</pre>"
+
+        def wrap(self, source, outfile=None):
+            """Return the source with a code, pre, and div."""
+            # return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
+            return self._wrap_code(source)
+
+    return HtmlCodeFormatter
+_html_code_formatter_class = _memoized(_html_code_formatter_class)
+
+# Formatters keyed by language and style options, and the HTML of the
+# highlighted code blocks keyed by language, style options and code hash.
+_pygments_formatter_cache = _LRUCache(64)
+_pygments_highlight_cache = _LRUCache(512)
+
+
 def _xml_oneliner_re_from_tab_width(tab_width):
     """Standalone XML processing instruction regex."""
     return re.compile(r"""
@@ -2312,6 +2887,147 @@ def _hr_tag_re_from_tab_width(tab_width):
         """ % (tab_width - 1), re.X)
 _hr_tag_re_from_tab_width = _memoized(_hr_tag_re_from_tab_width)
 
+def _outdent_re_from_tab_width(tab_width):
+    """One level of line-leading tabs or spaces."""
+    return re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
+_outdent_re_from_tab_width = _memoized(_outdent_re_from_tab_width)
+
+def _link_def_re_from_tab_width(tab_width):
+    """Link definition regex: `[id]: url "optional title"`."""
+    return re.compile(r"""
+        ^[ ]{0,%d}\[(.+)\]: # id = \1
+          [ \t]*
+          \n?               # maybe *one* newline
+          [ \t]*
+        <?(.+?)>?           # url = \2
+          [ \t]*
+        (?:
+            \n?             # maybe one newline
+            [ \t]*
+            (?<=\s)         # lookbehind for whitespace
+            ['"(]
+            ([^\n]*)        # title = \3
+            ['")]
+            [ \t]*
+        )?  # title is optional
+        (?:\n+|\Z)
+        """ % (tab_width - 1), re.X | re.M | re.U)
+_link_def_re_from_tab_width = _memoized(_link_def_re_from_tab_width)
+
+def _footnote_def_re_from_tab_width(tab_width):
+    """Footnote definition regex: `[^note-id]: Text of the note.`"""
+    return re.compile(r'''
+        ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
+        [ \t]*
+        (                       # footnote text = \2
+          # First line need not start with the spaces.
+          (?:\s*.*\n+)
+          (?:
+            (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
+            .*\n+
+          )*
+        )
+        # Lookahead for non-space at line-start, or end of doc.
+        (?:(?=^[ ]{0,%d}\S)|\Z)
+        ''' % (tab_width - 1, tab_width, tab_width),
+        re.X | re.M)
+_footnote_def_re_from_tab_width = _memoized(_footnote_def_re_from_tab_width)
+
+def _pyshell_block_re_from_tab_width(tab_width):
+    """Unindented Python interactive shell session ("pyshell" extra)."""
+    return re.compile(r"""
+        ^([ ]{0,%d})>>>[ ].*\n   # first line
+        ^(\1.*\S+.*\n)*         # any number of subsequent lines
+        ^\n                     # ends with a blank line
+        """ % (tab_width - 1), re.M | re.X)
+_pyshell_block_re_from_tab_width = _memoized(_pyshell_block_re_from_tab_width)
+
+def _table_re_from_tab_width(tab_width):
+    """GFM/PHP-Markdown Extra table regex ("tables" extra)."""
+    less_than_tab = tab_width - 1
+    return re.compile(r'''
+            (?:(?<=\n\n)|\A\n?)             # leading blank line
+
+            ^[ ]{0,%d}                      # allowed whitespace
+            (.*[|].*)  \n                   # $1: header row (at least one pipe)
+
+            ^[ ]{0,%d}                      # allowed whitespace
+            (                               # $2: underline row
+                # underline row with leading bar
+                (?:  \|\ *:?-+:?\ *  )+  \|?  \n
+                |
+                # or, underline row without leading bar
+                (?:  \ *:?-+:?\ *\|  )+  (?:  \ *:?-+:?\ *  )?  \n
+            )
+
+            (                               # $3: data rows
+                (?:
+                    ^[ ]{0,%d}(?!\ )         # ensure line begins with 0 to less_than_tab spaces
+                    .*\|.*  \n
+                )+
+            )
+        ''' % (less_than_tab, less_than_tab, less_than_tab), re.M | re.X)
+_table_re_from_tab_width = _memoized(_table_re_from_tab_width)
+
+def _wiki_table_re_from_tab_width(tab_width):
+    """Google Code Wiki-style table regex ("wiki-tables" extra)."""
+    return re.compile(r'''
+        (?:(?<=\n\n)|\A\n?)            # leading blank line
+        ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
+        (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
+        ''' % (tab_width - 1), re.M | re.X)
+_wiki_table_re_from_tab_width = _memoized(_wiki_table_re_from_tab_width)
+
+def _list_re_from_tab_width(tab_width, marker_pat, sub_list):
+    """Whole list regex for one kind of list marker. Sub-lists may start
+    on any line, top-level lists only after a blank line.
+    """
+    whole_list = r'''
+        (                   # \1 = whole list
+          (                 # \2
+            [ ]{0,%d}
+            (%s)            # \3 = first list item marker
+            [ \t]+
+            (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
+          )
+          (?:.+?)
+          (                 # \4
+              \Z
+            |
+              \n{2,}
+              (?=\S)
+              (?!           # Negative lookahead for another list item marker
+                [ \t]*
+                %s[ \t]+
+              )
+          )
+        )
+    ''' % (tab_width - 1, marker_pat, marker_pat)
+    if sub_list:
+        return re.compile("^"+whole_list, re.X | re.M | re.S)
+    else:
+        return re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
+                          re.X | re.M | re.S)
+_list_re_from_tab_width = _memoized(_list_re_from_tab_width)
+
+def _code_block_re_from_tab_width(tab_width):
+    """Indented `<pre><code>` block regex."""
+    return re.compile(r'''
+        (?:\n\n|\A\n?)
+        (               # $1 = the code block -- one or more lines, starting with a space/tab
+          (?:
+            (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
+            .*\n+
+          )+
+        )
+        ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
+        # Lookahead to make sure this block isn't already in a code block.
+        # Needed when syntax highlighting is being used.
+        (?![^<]*\</code\>)
+        ''' % (tab_width, tab_width),
+        re.M | re.X)
+_code_block_re_from_tab_width = _memoized(_code_block_re_from_tab_width)
+
 
 def _xml_escape_attr(attr, skip_single_quote=True):
     """Escape the given string for use in an HTML/XML tag attribute.
@@ -2351,9 +3067,372 @@ class _NoReflowFormatter(optparse.IndentedHelpFormatter):
     def format_description(self, description):
         return description or ""
 
+# Inputs on which some passes used to take time quadratic in the length of
+# the text (pasted logs, minified JS, runs of unclosed markup), each with the
+# seconds its conversion may take at most. Checked by `--self-test`.
+_pathological_cases = [
+    ("underscores", "_" * 20000, 1.0),
+    ("underscore words", "a_b " * 5000, 1.0),
+    ("unclosed em", "*a " * 5000, 1.0),
+    ("unclosed strong", "**a " * 5000, 1.0),
+    ("unclosed strike", "~~a " * 5000, 1.0),
+    ("unclosed underline", "==a " * 5000, 1.0),
+    ("code spans", "``a` " * 5000, 1.0),
+    ("open brackets", "[" * 20000, 1.0),
+    ("unclosed links", "[a](" * 5000, 1.0),
+    ("unclosed angle links", "[a](<" * 5000, 1.0),
+    ("brackets", "[a] " * 5000, 1.0),
+    ("unclosed divs", "<div>\n" * 5000, 1.0),
+    ("unclosed div paragraphs", "<div>x\n\n" * 5000, 1.0),
+    ("unclosed tags", '<a href="' * 5000, 1.0),
+    ("unclosed comments", "<!--\n\n" * 5000, 1.0),
+    ("angle brackets", "<" * 20000, 1.0),
+    ("lists", "- a\n\npara\n\n" * 2000, 1.0),
+    ("list items", "- a\n" * 5000, 1.0),
+    ("nested lists", "".join("  " * (i % 20) + "- a\n" for i in range(2000)), 1.0),
+    ("headers", "# a\n" * 5000, 1.0),
+    ("minified js", "var a=function(b){return b*2};_x=[1,2,3];" * 500, 1.0),
+    ("log lines", "2014-01-01 12:00:00 [INFO] some_module: *** value=<%s> ***\n"
+                  * 500, 1.0),
+    ("table pipes", "|" * 10000 + "\n|---|\n|a|\n", 1.0),
+    ("footnote refs", "[^1] " * 2000 + "\n\n[^1]: x\n", 1.0),
+    ("code spans and escapes", "".join("Call `f(%d)` with \\*args\\*.\n\n" % i
+                                       for i in range(2000)), 1.0),
+    ("ticket refs", "".join("Fixed in ABC-%d, see #%d and evernote:///view/"
+                            "1/s1/%d/ for details.\n" % (i, i, i)
+                            for i in range(4000)), 2.0),
+]
+
+# The link patterns for _pathological_cases, as used to auto-link tickets.
+_pathological_link_patterns = [
+    (re.compile(r"evernote:///\S+"), r"\g<0>"),
+    (re.compile(r"\b([A-Z]+-\d+)\b"), r"https://tickets.example.com/\1"),
+    (re.compile(r"#(\d+)"), r"https://example.com/issues/\1"),
+]
+
+def _test_pathological():
+    """Converts each of `_pathological_cases` and logs those taking longer
+    than their budget. Returns the number of those.
+    """
+    from time import time
+    extras = ["footnotes", "fenced-code-blocks", "tables", "wiki-tables",
+              "cuddled-lists", "markdown-in-html", "smarty-pants",
+              "link-patterns"]
+    failures = 0
+    for name, text, budget in _pathological_cases:
+        start = time()
+        markdown(text, extras=extras,
+                 link_patterns=_pathological_link_patterns)
+        elapsed = time() - start
+        if elapsed > budget:
+            log.error("%s: took %.2fs (budget %.2fs)", name, elapsed, budget)
+            failures += 1
+        else:
+            log.debug("%s: took %.2fs", name, elapsed)
+    return failures
+
+# Inputs whose HTML an optimisation once changed: the name, the text, the
+# keyword arguments to `markdown()` and the HTML expected. Checked by
+# `--self-test`.
+_output_cases = [
+    ("link patterns next to placeholders",
+     "See `foo` and issue 42, also \\*x\\* and <b>bold</b>.\n",
+     {"extras": ["link-patterns"],
+      "link_patterns": [(re.compile(r"\b(\d+)\b"), r"http://issues/\1")]},
+     '<p>See <code>foo</code> and issue <a href="http://issues/42">42</a>, '
+     'also *x* and <b>bold</b>.</p>\n'),
+    # The list used to be skipped, and left as a paragraph, when the HTML
+    # of the list before it was shorter than its markdown.
+    ("list after a list rendered shorter than its text",
+     "1. Add:\n```\n    import pkgutil\n"
+     "    __path__ = pkgutil.extend_path(__path__, __name__)\n```\n\n"
+     "* Directory structure:\n",
+     {},
+     '<ol>\n<li>Add:\n<code>\nimport pkgutil\n'
+     '__path__ = pkgutil.extend_path(__path__, __name__)\n</code></li>\n</ol>\n\n'
+     '<ul>\n<li>Directory structure:</li>\n</ul>\n'),
+    # The next comment used to be skipped, and wrapped in a paragraph,
+    # when the placeholder was shorter than the comment before it.
+    ("standalone comments one after the other",
+     "#### Is `PATH`?\n<!--  (e.g. `.bashrc`) -->\n\n<!-- Please remove -->",
+     {},
+     '<h4>Is <code>PATH</code>?</h4>\n\n<!--  (e.g. `.bashrc`) -->\n\n'
+     '<!-- Please remove -->\n'),
+    ("standalone comments around a paragraph",
+     "<!-- a comment longer than its placeholder -->\n\n<!-- two -->\n\n"
+     "text\n\n<!-- three -->\n",
+     {},
+     '<!-- a comment longer than its placeholder -->\n\n<!-- two -->\n\n'
+     '<p>text</p>\n\n<!-- three -->\n'),
+]
+
+def _test_outputs():
+    """Converts each of `_output_cases` and logs those not giving the HTML
+    expected. Returns the number of those.
+    """
+    failures = 0
+    for name, text, kwargs, expected in _output_cases:
+        html = markdown(text, **kwargs)
+        if html != expected:
+            log.error("%s: got %r, expected %r", name, html, expected)
+            failures += 1
+    return failures
+
+# Documents on which `IncrementalMarkdown` once gave other HTML than the
+# full conversion. Checked by `--self-test`, with `_bench_corpus()` and the
+# texts of `_output_cases`.
+_incremental_cases = [
+    ("definition between list items",
+     "- 1.4.0\n  - Add ... [checked cfgs], and call that\n\n"
+     "[checked cfgs]: https://e.com\n\n- 1.3.0 (2024-05-03)\n"),
+    ("definition only", "[a]: http://example.com/\n"),
+    ("empty", ""),
+    ("footnotes in several blocks",
+     "# Title[^1]\n\nPara[^2] text.\n\n- item[^3]\n\n"
+     "[^1]: One.\n\n[^2]: Two.\n\n[^3]: Three.\n"),
+    ("loose list items", "- a\n\n- b\n\n    more b\n- c\n\npara\n"),
+    ("comment after a line, then standalone comments",
+     "[![badge](https://img.shields.io/x.svg)](https://x)\n<!-- x -->\n\n"
+     "<!-- x -->\n\nText\n\n<!-- y -->\n"),
+    ("comment after a link definition",
+     "\n[1]: http://u \"T\"\n<!-- c -->\n\n    code\n\n> q<!-- c -->\n"),
+]
+
+def _test_incremental():
+    """Converts each of `_incremental_cases`, the texts of `_output_cases`
+    and `_bench_corpus()` (and, but for the larger documents of the
+    corpus, versions of them with a line removed, doubled or blanked) with
+    an `IncrementalMarkdown` kept across them and with `convert()`. Logs
+    those on which the HTML differs and returns the number of those.
+    """
+    failures = 0
+    # Without "metadata": the edits would break the metadata of the corpus.
+    extras_with_footnotes = dict((name, arg) for name, arg in _bench_extras.items()
+                                 if name != "metadata")
+    for extras in (extras_with_footnotes, ["tables", "cuddled-lists"]):
+        full = Markdown(extras=extras)
+        incremental = IncrementalMarkdown(extras=extras)
+        cases = (_incremental_cases + _bench_corpus() +
+                 [(name, text) for name, text, _, _ in _output_cases])
+        for name, text in cases:
+            lines = text.split("\n")
+            versions = [("", text)]
+            for i in range(len(lines) if len(lines) < 100 else 0):
+                versions += [
+                    (" without line %d" % (i + 1),
+                     "\n".join(lines[:i] + lines[i+1:])),
+                    (" with line %d doubled" % (i + 1),
+                     "\n".join(lines[:i+1] + lines[i:])),
+                    (" with line %d blanked" % (i + 1),
+                     "\n".join(lines[:i] + [""] + lines[i+1:])),
+                ]
+            for edit, version in versions:
+                if incremental.convert(version) != full.convert(version):
+                    log.error("%s%s: IncrementalMarkdown differs from "
+                              "convert()", name, edit)
+                    failures += 1
+    return failures
+
 def _test():
     import doctest
     doctest.testmod()
+    return _test_outputs() + _test_incremental() + _test_pathological()
+
+# The extras timed by `--bench` when no -x option is given: those the
+# Evernote plugin uses or lets users turn on, configured the same way.
+_bench_extras = {
+    "footnotes": None,
+    "cuddled-lists": None,
+    "fenced-code-blocks": {"noclasses": True, "cssclass": "", "style": "default"},
+    "tables": None,
+    "wiki-tables": None,
+    "code-friendly": None,
+    "metadata": None,
+    "markdown-in-html": None,
+}
+
+# The markdowner methods `--bench` reports the time of. The time of each
+# one does not include the time spent in the others it calls.
+_bench_passes = [
+    "_prepare", "_extract_metadata", "_detab", "_do_fenced_code_blocks",
+    "_color_with_pygments", "_hash_html_blocks", "_hash_html_spans",
+    "_strip_footnote_definitions", "_strip_link_definitions",
+    "_run_block_gamut", "_do_headers", "_do_lists", "_do_code_blocks",
+    "_do_block_quotes", "_do_tables", "_do_wiki_tables", "_form_paragraphs",
+    "_run_span_gamut", "_do_code_spans", "_escape_special_chars",
+    "_encode_backslash_escapes", "_do_links", "_do_auto_links",
+    "_do_link_patterns", "_encode_amps_and_angles", "_do_italics_and_bold",
+    "_do_smart_punctuation", "_add_footnotes", "_finish_fragment",
+    "_unescape_special_chars",
+]
+
+_bench_timer = getattr(time, "perf_counter", time.time)
+
+def _bench_corpus():
+    """Return a synthetic corpus of notes, as (name, text) pairs: a small
+    one, a large one mixing all kinds of blocks, and ones heavy on code,
+    tables and lists.
+    """
+    def meta(title):
+        return "---\ntitle: %s\ntags: bench, markdown\n---\n" % title
+
+    def para(i):
+        return ("Some *emphasis*, **strong** text, `code %d`, a [link][ref%d], "
+                "a footnote[^fn%d] and <span>inline HTML</span> & more.\n"
+                "A second line with <http://example.com/%d> and "
+                "some_snake_case_words.\n\n" % (i, i, i, i))
+
+    def defs(i):
+        return ('[ref%d]: http://example.com/ref/%d "Reference %d"\n\n'
+                '[^fn%d]: Footnote %d.\n\n' % (i, i, i, i, i))
+
+    def code(i):
+        return ("```python\ndef f%d(x):\n    # Double x.\n    return 2 * x\n\n"
+                "print(f%d(21))\n```\n\n    indented code %d\n\n" % (i, i, i))
+
+    def table(i, rows):
+        lines = ["| name | count | price | note |",
+                 "|------|------:|:-----:|------|"]
+        for r in range(rows):
+            lines.append("| item %d | %d | $%d.00 | *note* `%d` |"
+                         % (r, i + r, r, r))
+        wiki = ["|| *a* || b || c ||"] * (rows // 2)
+        return "\n".join(lines) + "\n\n" + "\n".join(wiki) + "\n\n"
+
+    def lists(i):
+        return ("Cuddled list for %d:\n- one\n- two *em*\n    - nested [a][ref%d]\n"
+                "        - deeper `code`\n- three\n\n1. first\n2. second\n\n"
+                "    continued paragraph\n\n3. third\n\n* [ ] todo %d\n"
+                "* [x] done\n\n" % (i, i, i))
+
+    def section(i):
+        return ("# Section %d\n\n" % i + para(i) + lists(i) + "> quoted *text* %d\n"
+                "> more\n\n" % i + code(i) + table(i, 4)
+                + '<div markdown="1">\n*html* block %d\n</div>\n\n***\n\n' % i
+                + defs(i))
+
+    return [
+        ("small", meta("small") + "# Small\n\n" + para(0) + lists(0) + defs(0)),
+        ("large", meta("large") + "".join(section(i) for i in range(150))),
+        ("code-heavy", meta("code") + "".join(para(i) + code(i) + code(i + 1)
+                                              + defs(i) for i in range(100))),
+        ("table-heavy", meta("tables") + "".join(para(i) + table(i, 12)
+                                                 + defs(i) for i in range(60))),
+        ("list-heavy", meta("lists") + "".join(lists(i) + lists(i + 1) + defs(i)
+                                               for i in range(150))),
+    ]
+
+class _PassTimer(object):
+    """Adds up, in `seconds`, the time a markdowner spends in each of the
+    given methods, less the time spent in the others it calls.
+    """
+    def __init__(self, markdowner, names):
+        self.seconds = {}
+        self._inner = []
+        for name in names:
+            method = getattr(markdowner, name, None)
+            if method is not None:
+                self.seconds[name] = 0.0
+                setattr(markdowner, name, self._timed(name, method))
+
+    def _timed(self, name, method):
+        def timed(*args, **kwargs):
+            self._inner.append(0.0)
+            start = _bench_timer()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = _bench_timer() - start
+                self.seconds[name] += elapsed - self._inner.pop()
+                if self._inner:
+                    self._inner[-1] += elapsed
+        return timed
+
+def _bench_time(corpus, extras, repeat):
+    """Return the best of `repeat` conversion times of each document of
+    `corpus` with the given extras.
+    """
+    markdowner = Markdown(extras=extras)
+    times = []
+    for name, text in corpus:
+        best = None
+        for i in range(repeat):
+            start = _bench_timer()
+            markdowner.convert(text)
+            elapsed = _bench_timer() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        times.append(best)
+    return times
+
+def _bench(corpus, extras=None, repeat=3, profile_path=None):
+    """Benchmark the conversion of `corpus`, a list of (name, text) pairs,
+    and return the report as a dict:
+
+    - "documents": the best time of each document, with all the extras;
+    - "passes": the time spent in each of `_bench_passes`, over the corpus;
+    - "extras": the time each extra adds to the corpus, i.e. the time with
+      all of them less the time without that one (it can be negative);
+    - "total" and "baseline": the time of the corpus with all the extras
+      (listed in "extras_used") and with none.
+
+    If `profile_path` is given, the corpus is also converted under cProfile
+    and the stats are saved there (see the `pstats` module).
+    """
+    if extras is None:
+        extras = _bench_extras
+    report = {"version": __version__, "python": sys.version.split()[0],
+              "repeat": repeat, "extras_used": sorted(extras)}
+
+    times = _bench_time(corpus, extras, repeat)
+    report["total"] = sum(times)
+    report["documents"] = dict(
+        (name, {"chars": len(text), "seconds": t})
+        for (name, text), t in zip(corpus, times))
+    report["baseline"] = sum(_bench_time(corpus, {}, repeat))
+    report["extras"] = {}
+    for extra in extras:
+        without = dict((e, arg) for e, arg in extras.items() if e != extra)
+        report["extras"][extra] = \
+            report["total"] - sum(_bench_time(corpus, without, repeat))
+
+    markdowner = Markdown(extras=extras)
+    timer = _PassTimer(markdowner, _bench_passes)
+    for name, text in corpus:
+        markdowner.convert(text)
+    report["passes"] = timer.seconds
+
+    if profile_path:
+        import cProfile
+        markdowner = Markdown(extras=extras)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        for name, text in corpus:
+            markdowner.convert(text)
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+    return report
+
+def _bench_summary(report):
+    """Format a `_bench` report as text tables, slowest first."""
+    lines = ["%-28s %8s %9s" % ("document", "chars", "seconds")]
+    for name, doc in sorted(report["documents"].items(),
+                            key=lambda item: -item[1]["seconds"]):
+        lines.append("%-28s %8d %9.4f" % (name, doc["chars"], doc["seconds"]))
+    lines.append("%-28s %8s %9.4f" % ("total", "", report["total"]))
+    lines.append("%-28s %8s %9.4f" % ("total without extras", "",
+                                      report["baseline"]))
+    lines.append("")
+    lines.append("%-37s %9s" % ("extra", "cost"))
+    for extra, seconds in sorted(report["extras"].items(),
+                                 key=lambda item: -item[1]):
+        lines.append("%-37s %9.4f" % (extra, seconds))
+    lines.append("")
+    lines.append("%-37s %9s" % ("pass", "seconds"))
+    for name, seconds in sorted(report["passes"].items(),
+                                key=lambda item: -item[1]):
+        lines.append("%-37s %9.4f" % (name, seconds))
+    return "\n".join(lines) + "\n"
 
 def main(argv=None):
     if argv is None:
@@ -2386,11 +3465,28 @@ def main(argv=None):
                            "<https://github.com/trentm/python-markdown2/wiki/Extras>")
     parser.add_option("--link-patterns-file",
                       help="path to a link pattern file")
+    parser.add_option("-j", "--jobs", type="int", metavar="N",
+                      help="convert the PATHS in N worker processes "
+                           "(0: one per CPU)")
+    parser.add_option("--bench", action="store_true",
+                      help="time the conversion of the PATHS (or of a "
+                           "built-in corpus of notes) per document, pass "
+                           "and extra, and print a summary")
+    parser.add_option("--bench-repeat", type="int", metavar="N",
+                      help="with --bench, keep the best of N conversions "
+                           "of each document (default 3)")
+    parser.add_option("--bench-json", metavar="PATH",
+                      help="with --bench, also write the report as JSON "
+                           "to PATH")
+    parser.add_option("--bench-profile", metavar="PATH",
+                      help="with --bench, also profile the conversions and "
+                           "save the cProfile stats to PATH")
     parser.add_option("--self-test", action="store_true",
                       help="run internal self-tests (some doctests)")
     parser.add_option("--compare", action="store_true",
                       help="run against Markdown.pl as well (for testing)")
-    parser.set_defaults(log_level=logging.INFO, compare=False,
+    parser.set_defaults(log_level=logging.INFO, compare=False, jobs=1,
+                        bench_repeat=3,
                         encoding="utf-8", safe_mode=None, use_file_vars=False)
     opts, paths = parser.parse_args()
     log.setLevel(opts.log_level)
@@ -2434,11 +3530,54 @@ def main(argv=None):
     else:
         link_patterns = None
 
+    if opts.bench:
+        if paths:
+            corpus = []
+            for path in paths:
+                fp = codecs.open(path, 'r', opts.encoding)
+                corpus.append((path, fp.read()))
+                fp.close()
+        else:
+            corpus = _bench_corpus()
+        report = _bench(corpus, extras=extras, repeat=opts.bench_repeat,
+                        profile_path=opts.bench_profile)
+        sys.stdout.write(_bench_summary(report))
+        if opts.bench_json:
+            import json
+            f = open(opts.bench_json, "w")
+            try:
+                json.dump(report, f, indent=2, sort_keys=True)
+            finally:
+                f.close()
+        return
+
     from os.path import join, dirname, abspath, exists
     markdown_pl = join(dirname(dirname(abspath(__file__))), "test",
                        "Markdown.pl")
     if not paths:
         paths = ['-']
+    if opts.jobs != 1 and len(paths) > 1 and not opts.compare:
+        texts = []
+        for path in paths:
+            if path == '-':
+                texts.append(sys.stdin.read())
+            else:
+                fp = codecs.open(path, 'r', opts.encoding)
+                texts.append(fp.read())
+                fp.close()
+        htmls = markdown_many(texts, processes=opts.jobs or None,
+            html4tags=opts.html4tags,
+            safe_mode=opts.safe_mode,
+            extras=extras, link_patterns=link_patterns,
+            use_file_vars=opts.use_file_vars)
+        for path, html in zip(paths, htmls):
+            log.debug("%s: converted in %.3fs", path, html.elapsed)
+            if py3:
+                sys.stdout.write(html)
+            else:
+                sys.stdout.write(html.encode(
+                    sys.stdout.encoding or "utf-8", 'xmlcharrefreplace'))
+        return
     for path in paths:
         if path == '-':
             text = sys.stdin.read()
@@ -2446,6 +3585,13 @@ def main(argv=None):
             fp = codecs.open(path, 'r', opts.encoding)
             text = fp.read()
             fp.close()
+        if py3 and not opts.compare and not (extras and "toc" in extras):
+            markdown_to(text, sys.stdout,
+                html4tags=opts.html4tags,
+                safe_mode=opts.safe_mode,
+                extras=extras, link_patterns=link_patterns,
+                use_file_vars=opts.use_file_vars)
+            continue
         if opts.compare:
             from subprocess import Popen, PIPE
             print("==== Markdown.pl ====")
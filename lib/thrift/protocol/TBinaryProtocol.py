@@ -120,8 +120,9 @@ class TBinaryProtocol(TProtocolBase):
 
   def writeString(self, str):
     self.writeI32(len(str))
-    if type(str) == bytes:
-      # The generators treat strings and byte arrays equally
+    if type(str) == bytes or not hasattr(str, 'encode'):
+      # The generators treat strings and byte arrays equally;
+      # any other buffer (e.g. a memory mapped file) is written as is
       self.trans.write(str)
     else:
       self.trans.write(bytes(str, "UTF-8"))
@@ -115,8 +115,8 @@ class THttpClient(TTransportBase):
       self.close()
     self.open()
 
-    # Pull data out of buffer
-    data = self.__wbuf.getvalue()
+    # Pull data out of buffer (without copying it)
+    data = self.__wbuf.getbuffer()
     self.__wbuf = BytesIO()
 
     # HTTP request
@@ -23,6 +23,7 @@ if lib_path not in sys.path:
     sys.path.append(lib_path)
 
 import evernote.edam.type.ttypes as Types
+import evernote.edam.limits.constants as Limits
 from evernote.edam.error.ttypes import EDAMErrorCode, EDAMUserException, EDAMSystemException, EDAMNotFoundException
 
 # import evernote.edam.userstore.UserStore as UserStore
@@ -38,8 +39,16 @@ import markdown2
 import html2text
 
 from datetime import datetime
+import threading
+import time
+import copy
 
+import zlib
 from base64 import b64encode, b64decode
+try:
+    from base64 import b85encode, b85decode
+except ImportError:  # Python 3.3
+    b85encode = b85decode = None
 
 EVERNOTE_PLUGIN_VERSION = "2.7.0"
 USER_AGENT = {'User-Agent': 'SublimeEvernote/' + EVERNOTE_PLUGIN_VERSION}
@@ -47,6 +56,11 @@ USER_AGENT = {'User-Agent': 'SublimeEvernote/' + EVERNOTE_PLUGIN_VERSION}
 EVERNOTE_SETTINGS = "Evernote.sublime-settings"
 SUBLIME_EVERNOTE_COMMENT_BEG = "<!-- Sublime:"
 SUBLIME_EVERNOTE_COMMENT_END = "-->"
+# The embedded markdown is stored as "<encoding>:<payload>" inside the comment.
+# Notes created by older versions of the plugin store plain base64 instead,
+# which never contains ':' so the two formats cannot be confused.
+EMBEDDED_ZLIB_B85 = "z85"
+EMBEDDED_ZLIB_B64 = "z64"
 
 DEBUG = False
 
@@ -85,6 +99,31 @@ def extract_metadata(text):
     return {"metadata": metadata, "contents": tail.lstrip('\n')}
 
 
+def encode_embedded_markdown(text):
+    data = zlib.compress(text.encode('utf8'))
+    if b85encode:
+        # '-' is the only base85 char that is not allowed in an XML comment
+        # (as part of '--') and '.' is not in the base85 alphabet.
+        payload = b85encode(data).decode('ascii').replace('-', '.')
+        return "%s:%s" % (EMBEDDED_ZLIB_B85, payload)
+    return "%s:%s" % (EMBEDDED_ZLIB_B64, b64encode(data).decode('ascii'))
+
+
+def decode_embedded_markdown(payload):
+    payload = payload.strip()
+    encoding, sep, data = payload.partition(':')
+    if not sep:
+        # Legacy format: uncompressed base64
+        return b64decode(payload.encode('utf8')).decode('utf8')
+    if encoding == EMBEDDED_ZLIB_B85 and b85decode:
+        data = b85decode(data.replace('.', '-').encode('ascii'))
+    elif encoding == EMBEDDED_ZLIB_B64:
+        data = b64decode(data.encode('ascii'))
+    else:
+        raise ValueError("Unsupported embedded markdown encoding '%s'" % encoding)
+    return zlib.decompress(data).decode('utf8')
+
+
 METADATA_HEADER = """\
 ---
 title: %s
@@ -98,6 +137,45 @@ notebook: %s
 def metadata_header(title="", tags=[], notebook="", **kw):
     return METADATA_HEADER % (title, json.dumps(tags, ensure_ascii=False), notebook)
 
+def note_to_markdown(note, tags, nb_name, config=None):
+    """Returns the markdown source of a note with its metadata header.
+
+    The markdown embedded by the plugin is used when present, otherwise
+    the ENML contents are converted with html2text's ENML converter, with
+    the html2text `config`.
+    """
+    meta = metadata_header(note.title, tags, nb_name)
+    mdtxt = ""
+    builtin = note.content.find(SUBLIME_EVERNOTE_COMMENT_BEG, 0, 150)
+    if builtin >= 0:
+        try:
+            builtin_end = note.content.find(SUBLIME_EVERNOTE_COMMENT_END, builtin)
+            bmdtxt = note.content[builtin+len(SUBLIME_EVERNOTE_COMMENT_BEG):builtin_end]
+            mdtxt = decode_embedded_markdown(bmdtxt)
+            parts = extract_metadata(mdtxt)
+            if parts["metadata"]:
+                if parts["metadata"].get("title") == note.title and \
+                   "tags" in parts["metadata"] and \
+                   set(parts["metadata"].get("tags")) == set(tags) and \
+                   parts["metadata"].get("notebook") == nb_name:
+                    meta = ""
+                else:
+                    LOG("Overridding metadata")
+                    mdtxt = parts["contents"]
+            LOG("Loaded from built-in comment")
+        except Exception as e:
+            mdtxt = ""
+            LOG("Loading from built-in comment failed", e)
+    if builtin < 0 or mdtxt == "":
+        try:
+            mdtxt = html2text.enml2text(note.content, config=config)
+            LOG("Conversion ok")
+        except Exception as e:
+            mdtxt = note.content
+            LOG("Conversion failed", e)
+    return meta + mdtxt
+
+
 def set_view_metadata(view, note, reset_modified=True):
     view.settings().set("$evernote", True)
     view.settings().set("$evernote_guid", note.guid)
@@ -175,6 +253,177 @@ error_groups = {
     }
 
 
+# Elements and attributes allowed by the ENML 2 DTD
+# (http://xml.evernote.com/pub/enml2.dtd); the attributes in ENML_ATTRS
+# are accepted on every element.
+ENML_ATTRS = frozenset(["style", "title", "lang", "xml:lang", "dir"])
+_CELL_ALIGN = ["align", "char", "charoff", "valign"]
+ENML_ELEMENTS = {
+    "en-note": ["bgcolor", "text"],
+    "en-media": ["type", "hash", "height", "width", "usemap", "align", "border",
+                 "hspace", "vspace", "longdesc", "alt"],
+    "en-crypt": ["hint", "cipher", "length"],
+    "en-todo": ["checked"],
+    "a": ["charset", "type", "name", "href", "hreflang", "rel", "rev", "shape",
+          "coords", "target"],
+    "img": ["src", "alt", "name", "longdesc", "height", "width", "usemap",
+            "ismap", "align", "border", "hspace", "vspace"],
+    "area": ["shape", "coords", "href", "nohref", "alt", "target"],
+    "map": ["name"],
+    "table": ["summary", "width", "border", "frame", "rules", "cellspacing",
+              "cellpadding", "align", "bgcolor"],
+    "caption": ["align"],
+    "col": ["span", "width"] + _CELL_ALIGN,
+    "colgroup": ["span", "width"] + _CELL_ALIGN,
+    "thead": _CELL_ALIGN, "tbody": _CELL_ALIGN, "tfoot": _CELL_ALIGN,
+    "tr": _CELL_ALIGN + ["bgcolor"],
+    "td": _CELL_ALIGN + ["abbr", "axis", "headers", "scope", "rowspan",
+                         "colspan", "nowrap", "bgcolor", "width", "height"],
+    "th": _CELL_ALIGN + ["abbr", "axis", "headers", "scope", "rowspan",
+                         "colspan", "nowrap", "bgcolor", "width", "height"],
+    "p": ["align"], "div": ["align"],
+    "h1": ["align"], "h2": ["align"], "h3": ["align"],
+    "h4": ["align"], "h5": ["align"], "h6": ["align"],
+    "hr": ["align", "noshade", "size", "width"],
+    "ol": ["type", "compact", "start"], "ul": ["type", "compact"],
+    "li": ["type", "value"], "dl": ["compact"], "dt": [], "dd": [],
+    "pre": ["width", "xml:space"],
+    "blockquote": ["cite"], "q": ["cite"],
+    "ins": ["cite", "datetime"], "del": ["cite", "datetime"],
+    "br": ["clear"], "font": ["size", "color", "face"], "bdo": [],
+    "abbr": [], "acronym": [], "address": [], "b": [], "big": [], "center": [],
+    "cite": [], "code": [], "dfn": [], "em": [], "i": [], "kbd": [], "s": [],
+    "samp": [], "small": [], "span": [], "strike": [], "strong": [], "sub": [],
+    "sup": [], "tt": [], "u": [], "var": [], "xmp": [],
+}
+ENML_ELEMENTS = dict((tag, ENML_ATTRS.union(attrs)) for tag, attrs in ENML_ELEMENTS.items())
+
+
+class ENMLValidationError(Exception):
+
+    def __init__(self, problems):
+        self.problems = problems
+        Exception.__init__(self, "\n".join(problems))
+
+    def __str__(self):
+        shown = self.problems[:10]
+        if len(self.problems) > 10:
+            shown.append("(%d more problems)" % (len(self.problems) - 10))
+        return "The contents of the note are not valid:\n" + "\n".join(shown)
+
+
+def validate_enml(content, fix=False):
+    """Checks `content` against the ENML DTD and Evernote's limits.
+
+    Returns a pair with the content, where disallowed attributes have been
+    removed if `fix` is true, and the list of the problems found, each
+    prefixed by its position (line and column) in the content.
+    """
+    from xml.parsers import expat
+    data = content.encode("utf-8")
+    problems = []
+    fixes = []  # (byte offset of start tag, attributes to remove)
+    depth = [0]
+    parser = expat.ParserCreate()
+    parser.ordered_attributes = True
+
+    def problem(msg):
+        problems.append("line %d, column %d: %s" % (
+            parser.CurrentLineNumber, parser.CurrentColumnNumber + 1, msg))
+
+    def start(tag, attrs):
+        depth[0] += 1
+        if depth[0] == 1 and tag != "en-note":
+            problem("the root element must be <en-note>, not <%s>" % tag)
+        if tag not in ENML_ELEMENTS:
+            problem("element <%s> is not allowed" % tag)
+            return
+        allowed = ENML_ELEMENTS[tag]
+        bad = []
+        for name, value in zip(attrs[::2], attrs[1::2]):
+            if name not in allowed:
+                bad.append(name)
+            elif len(value) > Limits.EDAM_ATTRIBUTE_LEN_MAX:
+                problem("attribute '%s' of <%s> is longer than %d characters" % (
+                    name, tag, Limits.EDAM_ATTRIBUTE_LEN_MAX))
+        if bad:
+            if fix:
+                fixes.append((parser.CurrentByteIndex, bad))
+            else:
+                for name in bad:
+                    problem("attribute '%s' is not allowed on <%s>" % (name, tag))
+        if tag == "en-media":
+            for required in ("type", "hash"):
+                if required not in attrs[::2]:
+                    problem("<en-media> requires a '%s' attribute" % required)
+
+    def end(tag):
+        depth[0] -= 1
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    try:
+        parser.Parse(data, True)
+    except expat.ExpatError as e:
+        problems.append("line %d, column %d: %s" % (
+            e.lineno, e.offset + 1, expat.ErrorString(e.code)))
+
+    if len(data) > Limits.EDAM_NOTE_CONTENT_LEN_MAX:
+        problems.append("the note is %d bytes long, Evernote accepts at most %d" % (
+            len(data), Limits.EDAM_NOTE_CONTENT_LEN_MAX))
+
+    if fixes:
+        parts = []
+        last = 0
+        for offset, names in fixes:
+            # Attribute values may contain ">" and anything that looks
+            # like an attribute.
+            end_tag = html2text.enml_tag_end.match(data, offset + 1).end() - 1
+            names = set(name.encode("utf-8") for name in names)
+            tag = re.sub(br'\s+([^\s=]+)\s*=\s*(?:"[^"]*"|\'[^\']*\')',
+                         lambda m: b"" if m.group(1) in names else m.group(0),
+                         data[offset:end_tag])
+            parts.extend([data[last:offset], tag])
+            last = end_tag
+        parts.append(data[last:])
+        content = b"".join(parts).decode("utf-8")
+        LOG("Removed disallowed attributes", fixes)
+    return content, problems
+
+
+def valid_edam_name(name, forbidden=""):
+    # Python's re has no \p{...} classes so EDAM_NOTE_TITLE_REGEX and
+    # EDAM_TAG_NAME_REGEX are checked by Unicode category instead.
+    import unicodedata
+    cats = [unicodedata.category(c) for c in name]
+    return bool(name) and \
+        not any(c in forbidden for c in name) and \
+        not any(cat in ("Cc", "Zl", "Zp") for cat in cats) and \
+        not cats[0].startswith("Z") and not cats[-1].startswith("Z")
+
+
+def validate_note(note, fix=False):
+    """Validates the contents and metadata of a note before uploading it,
+    raising ENMLValidationError if Evernote would reject it."""
+    note.content, problems = validate_enml(note.content, fix)
+    title = note.title or ""
+    if not Limits.EDAM_NOTE_TITLE_LEN_MIN <= len(title) <= Limits.EDAM_NOTE_TITLE_LEN_MAX:
+        problems.append("the title must be between %d and %d characters long" % (
+            Limits.EDAM_NOTE_TITLE_LEN_MIN, Limits.EDAM_NOTE_TITLE_LEN_MAX))
+    elif not valid_edam_name(title):
+        problems.append("the title cannot start or end with spaces "
+                        "or contain line breaks")
+    tags = note.tagNames or []
+    if len(tags) > Limits.EDAM_NOTE_TAGS_MAX:
+        problems.append("a note can have at most %d tags" % Limits.EDAM_NOTE_TAGS_MAX)
+    for tag in tags:
+        if len(tag) > Limits.EDAM_TAG_NAME_LEN_MAX or not valid_edam_name(tag, ","):
+            problems.append("'%s' is not a valid tag name" % tag)
+    if problems:
+        raise ENMLValidationError(problems)
+    return note
+
+
 def errcode2name(err):
     name = ecode._VALUES_TO_NAMES.get(err.errorCode, "UNKNOWN")
     name = name.replace("_", " ").capitalize()
@@ -221,6 +470,8 @@ def explain_error(err):
     elif isinstance(err, EDAMNotFoundException):
         printError("Evernote error: [%s = %s]\n\tNot found" % (err.identifier, err.key))
         return "Cannot find %s" % err.identifier.split('.', 1)[0]
+    elif isinstance(err, (AttachmentTooLarge, ENMLValidationError)):
+        return str(err)
     elif isinstance(err, gaierror):
         printError("Evernote error: [socket]\n\t%s" % str(err))
         return 'The Evernote services seem unreachable.\n'\
@@ -278,9 +529,175 @@ def async_do(f, progress_msg="Evernote operation", done_msg="", on_completion=No
     sublime.set_timeout_async(lambda: do_stuff(status), 0)
 
 
+def sync_snapshot_path():
+    return os.path.join(sublime.cache_path(), "Evernote", "sync_state.json")
+
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _executor = ThreadPoolExecutor(max_workers=4)
+    return _executor
+
+
+def call_async(f, on_done=None, on_error=None):
+    """Runs `f` in the background and calls `on_done` with its result,
+    or `on_error` with the exception it raised, on Sublime's main thread.
+    Errors are shown in a dialog when `on_error` is not given."""
+
+    def callback(future):
+        try:
+            result = future.result()
+        except Exception as e:
+            LOG(e)
+            if on_error:
+                sublime.set_timeout(lambda e=e: on_error(e), 0)
+            else:
+                sublime.set_timeout(lambda e=e: sublime.error_message(explain_error(e)), 0)
+            return
+        if on_done:
+            sublime.set_timeout(lambda: on_done(result), 0)
+
+    future = get_executor().submit(f)
+    future.add_done_callback(callback)
+    return future
+
+
+def sizestr(n):
+    for unit in ["B", "KB", "MB"]:
+        if n < 1024:
+            return "%.0f%s" % (n, unit) if unit == "B" else "%.1f%s" % (n, unit)
+        n /= 1024.0
+    return "%.1fGB" % n
+
+
+class BatchProgress():
+    """Thread safe counters of a batch operation shown in the status bar."""
+
+    def __init__(self, msg, total=0):
+        self.msg = msg
+        self.total = total
+        self.done = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+        self.finished = False
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, done=0, skipped=0, failed=0, size=0, total=0):
+        with self._lock:
+            self.done += done
+            self.skipped += skipped
+            self.failed += failed
+            self.bytes += size
+            self.total += total
+
+    def status(self):
+        elapsed = max(time.time() - self.start, 0.001)
+        msg = "%s: %d/%d" % (self.msg, self.done + self.skipped + self.failed, self.total)
+        if self.bytes:
+            msg += ", %s at %s/s" % (sizestr(self.bytes), sizestr(self.bytes / elapsed))
+        if self.skipped:
+            msg += ", %d skipped" % self.skipped
+        if self.failed:
+            msg += ", %d failed" % self.failed
+        return msg
+
+    def show(self):
+        if self.finished:
+            sublime.status_message(self.status() + " (done in %.0fs)" % (time.time() - self.start))
+        else:
+            sublime.status_message(self.status())
+            sublime.set_timeout(self.show, 500)
+
+    def finish(self):
+        self.finished = True
+
+
+class CompletionIndex():
+    """Index of names for completions.
+
+    Names are kept sorted by their lowercase form so that case insensitive
+    prefix lookups are a bisection; when a query has few prefix matches,
+    names starting with the same character and containing the rest of the
+    query in order (fuzzy matches, e.g. "pth" for "python-tips") follow.
+    Within each group recently used names come first.
+    Safe to share between threads.
+    """
+
+    def __init__(self, names=()):
+        self.keys = []
+        self.uses = {}
+        self.clock = 0
+        self.lock = threading.Lock()
+        self.reset(names)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def reset(self, names):
+        """Replaces all the names, remembering when they were last used."""
+        keys = sorted(set((name.lower(), name) for name in names))
+        with self.lock:
+            self.keys = keys
+
+    def add(self, name):
+        from bisect import bisect_left
+        key = (name.lower(), name)
+        with self.lock:
+            i = bisect_left(self.keys, key)
+            if i == len(self.keys) or self.keys[i] != key:
+                self.keys.insert(i, key)
+
+    def remove(self, name):
+        from bisect import bisect_left
+        key = (name.lower(), name)
+        with self.lock:
+            i = bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+
+    def use(self, name):
+        with self.lock:
+            self.clock += 1
+            self.uses[name] = self.clock
+
+    def prefixed(self, prefix):
+        from bisect import bisect_left
+        prefix = prefix.lower()
+        with self.lock:
+            lo = bisect_left(self.keys, (prefix,))
+            hi = bisect_left(self.keys, (prefix + "\uffff",))
+            return [name for _, name in self.keys[lo:hi]]
+
+    def search(self, query, limit=50):
+        with self.lock:
+            uses = dict(self.uses)
+        recency = lambda name: -uses.get(name, 0)
+        found = sorted(self.prefixed(query), key=recency)
+        if len(found) >= limit or not query:
+            return found[:limit]
+        query = query.lower()
+        fuzzy = re.compile(".*?".join(re.escape(c) for c in query))
+        matches = []
+        for name in self.prefixed(query[0]):
+            key = name.lower()
+            m = fuzzy.match(key)
+            if m and not key.startswith(query):
+                # tighter matches rank higher
+                matches.append((recency(name), m.end(), name))
+        matches.sort()
+        return found + [name for _, _, name in matches[:limit - len(found)]]
+
+
 class EvernoteDo():
 
-    _noteStore = None
+    _thread_local = threading.local()
 
     _notebook_by_guid = None
     _notebook_by_name = None
@@ -288,6 +705,14 @@ class EvernoteDo():
 
     _tag_name_cache = {}
     _tag_guid_cache = {}
+    _tag_index = CompletionIndex()
+    _notebook_index = CompletionIndex()
+
+    _resource_cache = None
+
+    _note_counts = None
+
+    _inline_css_setting = None
 
     MD_EXTRAS = {
         'footnotes'          : None,
@@ -319,25 +744,33 @@ class EvernoteDo():
             EvernoteDo.MD_EXTRAS['fenced-code-blocks']['style'] = pygm_style
         if self.settings.get("code_friendly"):
             EvernoteDo.MD_EXTRAS['code-friendly'] = None
-            html2text.EMPHASIS_MARK = "*"
+            emphasis_mark = "*"
         else:
-            html2text.EMPHASIS_MARK = self.settings.get('emphasis_mark', html2text.EMPHASIS_MARK)
+            emphasis_mark = self.settings.get('emphasis_mark', html2text.EMPHASIS_MARK)
         if self.settings.get("wiki_tables"):
             EvernoteDo.MD_EXTRAS['wiki-tables'] = None
         if self.settings.get("gfm_tables"):
             EvernoteDo.MD_EXTRAS['tables'] = None
         css = self.settings.get("inline_css")
-        if css is not None:
+        if css is not None and css != EvernoteDo._inline_css_setting:
+            # Only normalised when the setting changes: the same dict is
+            # kept otherwise, and so is the markdowner built from it.
+            EvernoteDo._inline_css_setting = css
+            inline_css = {}
             for tag in css:
-                css[tag] = css[tag].strip()
-                if not css[tag].endswith(";"):
-                    css[tag] = css[tag] + ";"
-            EvernoteDo.MD_EXTRAS['inline-css'] = css
+                inline_css[tag] = css[tag].strip()
+                if not inline_css[tag].endswith(";"):
+                    inline_css[tag] = inline_css[tag] + ";"
+            EvernoteDo.MD_EXTRAS['inline-css'] = inline_css
         self.md_syntax = self.settings.get("md_syntax")
         if not self.md_syntax:
             self.md_syntax = find_syntax("Evernote")
-        html2text.UL_ITEM_MARK = self.settings.get('item_mark', html2text.UL_ITEM_MARK)
-        html2text.STRONG_MARK = self.settings.get('strong_mark', html2text.STRONG_MARK)
+        # Passed to each conversion rather than set on the html2text module,
+        # which conversions running in other threads read too.
+        self.html2text_config = html2text.Config(
+            emphasis_mark=emphasis_mark,
+            ul_item_mark=self.settings.get('item_mark', html2text.UL_ITEM_MARK),
+            strong_mark=self.settings.get('strong_mark', html2text.STRONG_MARK))
 
     def message(self, msg):
         sublime.status_message(msg)
@@ -393,17 +826,35 @@ class EvernoteDo():
                 "Developer Token (required):", token or "",
                 on_token, None, None)
 
-    def get_note_store(self):
-        if EvernoteDo._noteStore:
-            return EvernoteDo._noteStore
+    def new_note_store(self):
         noteStoreUrl = self.settings.get("noteStoreUrl")
         noteStoreHttpClient = THttpClient.THttpClient(noteStoreUrl)
         noteStoreHttpClient.setCustomHeaders(USER_AGENT)
         noteStoreProtocol = TBinaryProtocol.TBinaryProtocol(noteStoreHttpClient)
-        noteStore = NoteStore.Client(noteStoreProtocol)
-        EvernoteDo._noteStore = noteStore
+        return NoteStore.Client(noteStoreProtocol)
+
+    def get_note_store(self):
+        # Thrift clients cannot be shared between threads:
+        # each thread gets its own client.
+        noteStore = getattr(EvernoteDo._thread_local, "noteStore", None)
+        if noteStore is None:
+            noteStore = EvernoteDo._thread_local.noteStore = self.new_note_store()
         return noteStore
 
+    def iter_notes(self, note_filter, result_spec=None, page_size=100):
+        """Yields the metadata of all the notes matching `note_filter`,
+        fetching them one page at a time."""
+        result_spec = result_spec or NoteStore.NotesMetadataResultSpec(includeTitle=True)
+        offset = 0
+        while True:
+            page = self.get_note_store().findNotesMetadata(
+                self.token(), note_filter, offset, page_size, result_spec)
+            for note in page.notes:
+                yield note
+            offset += len(page.notes)
+            if not page.notes or offset >= page.totalNotes:
+                break
+
     def get_notebooks(self):
         if EvernoteDo._notebooks_cache:
             LOG("Using cached notebooks list")
@@ -414,15 +865,19 @@ class EvernoteDo():
             self.message("Fetching notebooks, please wait...")
             notebooks = noteStore.listNotebooks(self.token())
             self.message("Fetched all notebooks!")
-            if self.settings.get("sort_notebooks"):
-                notebooks.sort(key=lambda nb: nb.name)
         except Exception as e:
             sublime.error_message(explain_error(e))
             LOG(e)
             return []
+        return self.set_notebooks(notebooks)
+
+    def set_notebooks(self, notebooks):
+        if self.settings.get("sort_notebooks"):
+            notebooks.sort(key=lambda nb: nb.name)
         EvernoteDo._notebook_by_name = dict([(nb.name, nb) for nb in notebooks])
         EvernoteDo._notebook_by_guid = dict([(nb.guid, nb) for nb in notebooks])
         EvernoteDo._notebooks_cache = notebooks
+        EvernoteDo._notebook_index.reset(nb.name for nb in notebooks)
         return notebooks
 
     def create_notebook(self, name):
@@ -452,9 +907,7 @@ class EvernoteDo():
 
     def tag_from_guid(self, guid):
         if guid not in EvernoteDo._tag_name_cache:
-            name = self.get_note_store().getTag(self.token(), guid).name
-            EvernoteDo._tag_name_cache[guid] = name
-            EvernoteDo._tag_guid_cache[name] = guid
+            self.cache_tag(guid, self.get_note_store().getTag(self.token(), guid).name)
         return EvernoteDo._tag_name_cache[guid]
 
     def tag_from_name(self, name):
@@ -466,22 +919,181 @@ class EvernoteDo():
     def cache_all_tags(self):
         tags = self.get_note_store().listTags(self.token())
         for tag in tags:
-            EvernoteDo._tag_name_cache[tag.guid] = tag.name
-            EvernoteDo._tag_guid_cache[tag.name] = tag.guid
+            self.cache_tag(tag.guid, tag.name)
+
+    @staticmethod
+    def cache_tag(guid, name):
+        old = EvernoteDo._tag_name_cache.get(guid)
+        if old is not None and old != name:
+            EvernoteDo.uncache_tag(guid)
+        EvernoteDo._tag_name_cache[guid] = name
+        EvernoteDo._tag_guid_cache[name] = guid
+        EvernoteDo._tag_index.add(name)
+
+    @staticmethod
+    def uncache_tag(guid):
+        name = EvernoteDo._tag_name_cache.pop(guid, None)
+        if name is not None:
+            EvernoteDo._tag_guid_cache.pop(name, None)
+            EvernoteDo._tag_index.remove(name)
+
+    @staticmethod
+    def set_tags(tags):
+        tags = list(tags)
+        EvernoteDo._tag_name_cache = dict(tags)
+        EvernoteDo._tag_guid_cache = dict((name, guid) for guid, name in tags)
+        EvernoteDo._tag_index.reset(name for _, name in tags)
+
+    def sync_account(self):
+        """The note store URL and the id of the user the token belongs to,
+        which a sync snapshot must both match."""
+        try:
+            user_id = self.get_user_id()
+        except (AttributeError, IndexError, ValueError):
+            user_id = None
+        return [self.settings.get("noteStoreUrl"), user_id]
+
+    def load_sync_snapshot(self):
+        """Fills the notebook and tag caches from the snapshot saved by a
+        previous session; returns the snapshot or None if there is none
+        for the current account."""
+        try:
+            with open(sync_snapshot_path(), encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return None
+        account = self.sync_account()
+        if None in account or [snapshot.get("noteStoreUrl"), snapshot.get("userId")] != account:
+            return None
+        self.set_notebooks([Types.Notebook(**nb) for nb in snapshot["notebooks"]])
+        self.set_tags(snapshot["tags"])
+        LOG("Loaded notebooks and tags at USN %s" % snapshot["usn"])
+        return snapshot
+
+    def save_sync_snapshot(self, usn, sync_time):
+        url, user_id = self.sync_account()
+        snapshot = {
+            "noteStoreUrl": url,
+            "userId": user_id,
+            "usn": usn,
+            "time": sync_time,
+            "notebooks": [{"guid": nb.guid, "name": nb.name, "stack": nb.stack,
+                           "defaultNotebook": nb.defaultNotebook}
+                          for nb in EvernoteDo._notebooks_cache or []],
+            "tags": sorted(EvernoteDo._tag_name_cache.items()),
+        }
+        path = sync_snapshot_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".part", "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(path + ".part", path)
+
+    def warm_up(self):
+        """Brings the notebook and tag caches up to date.
+
+        Starts from the snapshot of the previous session and only fetches
+        what changed since its update sequence number (USN); the full
+        lists are downloaded when there is no usable snapshot.
+        """
+        snapshot = self.load_sync_snapshot()
+        noteStore = self.get_note_store()
+        state = noteStore.getSyncState(self.token())
+        if snapshot and snapshot["usn"] == state.updateCount:
+            return
+        if not snapshot or (state.fullSyncBefore or 0) > snapshot.get("time", 0):
+            LOG("Fetching all notebooks and tags")
+            self.set_notebooks(noteStore.listNotebooks(self.token()))
+            self.set_tags([])
+            self.cache_all_tags()
+        else:
+            LOG("Fetching changes since USN %s" % snapshot["usn"])
+            self.sync_chunks(snapshot["usn"], state.updateCount)
+        self.save_sync_snapshot(state.updateCount, state.currentTime)
+
+    def sync_chunks(self, usn, update_count):
+        chunk_filter = NoteStore.SyncChunkFilter(
+            includeNotebooks=True, includeTags=True, includeExpunged=True)
+        notebooks = dict((nb.guid, nb) for nb in EvernoteDo._notebooks_cache or [])
+        while usn < update_count:
+            chunk = self.get_note_store().getFilteredSyncChunk(
+                self.token(), usn, 256, chunk_filter)
+            for nb in chunk.notebooks or []:
+                notebooks[nb.guid] = nb
+            for guid in chunk.expungedNotebooks or []:
+                notebooks.pop(guid, None)
+            for tag in chunk.tags or []:
+                self.cache_tag(tag.guid, tag.name)
+            for guid in chunk.expungedTags or []:
+                self.uncache_tag(guid)
+            if chunk.chunkHighUSN is None:
+                break
+            usn = chunk.chunkHighUSN
+        self.set_notebooks(list(notebooks.values()))
+
+    def get_note_counts(self):
+        """Returns the number of notes in each notebook and tag.
+
+        The counts are fetched with a single findNoteCounts call and reused
+        until the account's update count changes."""
+        noteStore = self.get_note_store()
+        usn = noteStore.getSyncState(self.token()).updateCount
+        cached = EvernoteDo._note_counts
+        if cached and cached[0] == usn:
+            return cached[1]
+        counts = noteStore.findNoteCounts(self.token(), NoteStore.NoteFilter(), False)
+        EvernoteDo._note_counts = (usn, counts)
+        return counts
+
+    def get_resource_cache(self):
+        max_size = self.settings.get("resource_cache_size", 256)
+        if not max_size:
+            return None
+        max_size = max_size * 1024 * 1024
+        cache = EvernoteDo._resource_cache
+        if cache is None:
+            path = os.path.join(sublime.cache_path(), "Evernote", "resources")
+            cache = EvernoteDo._resource_cache = ResourceCache(path, max_size)
+        cache.max_size = max_size
+        return cache
 
     @staticmethod
     def clear_cache():
-        EvernoteDo._noteStore = None
+        EvernoteDo._thread_local = threading.local()
         EvernoteDo._notebook_by_name = None
         EvernoteDo._notebook_by_guid = None
         EvernoteDo._notebooks_cache = None
-        EvernoteDo._tag_guid_cache = {}
-        EvernoteDo._tag_name_cache = {}
+        EvernoteDo._note_counts = None
+        EvernoteDo.set_tags([])
+        try:
+            os.remove(sync_snapshot_path())
+        except OSError:
+            pass
 
-    def populate_note(self, note, contents):
+    def check_note(self, note):
+        return validate_note(note, fix=self.settings.get("enml_autofix", False))
+
+    def markdown(self, contents):
+        """Convert markdown with a converter kept across saves, so only the
+        blocks changed since the last conversion are rendered again.
+
+        Each thread has its own converter, so renders running in parallel
+        neither wait for each other nor evict each other's blocks."""
+        local = EvernoteDo._thread_local
+        extras = repr(sorted(EvernoteDo.MD_EXTRAS.items()))
+        markdowner = getattr(local, "markdowner", None)
+        if markdowner is None or local.markdowner_extras != extras:
+            markdowner = local.markdowner = markdown2.IncrementalMarkdown(
+                extras=copy.deepcopy(EvernoteDo.MD_EXTRAS))
+            local.markdowner_extras = extras
+        return markdowner.convert(contents)
+
+    def populate_note(self, note, contents, notebooks=None):
+        """Fills `note` from the markdown `contents` and its metadata.
+        The notebook named there is looked up in `notebooks`, fetched
+        when not given."""
         if isinstance(contents, sublime.View):
             contents = contents.substr(sublime.Region(0, contents.size()))
-        body = markdown2.markdown(contents, extras=EvernoteDo.MD_EXTRAS)
+        body = self.markdown(contents)
 
         wrapper_style = ''
         if 'inline-css' in EvernoteDo.MD_EXTRAS:
@@ -494,7 +1106,7 @@ class EvernoteDo():
         content += '<en-note style="%s">' % wrapper_style
         hidden = ('\n%s%s%s\n' %
                     (SUBLIME_EVERNOTE_COMMENT_BEG,
-                     b64encode(contents.encode('utf8')).decode('utf8'),
+                     encode_embedded_markdown(contents),
                      SUBLIME_EVERNOTE_COMMENT_END))
         content += hidden
         content += body
@@ -507,8 +1119,13 @@ class EvernoteDo():
         LOG(tags)
         note.tagNames = tags
         note.content = content
+        for tag in tags or []:
+            EvernoteDo._tag_index.add(tag)
+            EvernoteDo._tag_index.use(tag)
         if "notebook" in meta:
-            notebooks = self.get_notebooks()
+            EvernoteDo._notebook_index.use(meta["notebook"])
+            if notebooks is None:
+                notebooks = self.get_notebooks()
             for nb in notebooks:
                 if nb.name == meta["notebook"]:
                     note.notebookGuid = nb.guid
@@ -569,17 +1186,11 @@ class SendToEvernoteCommand(EvernoteDoText):
         self.do_send(**kwargs)
 
     def do_send(self, **args):
-        noteStore = self.get_note_store()
         note = Types.Note()
         view = self.view
 
         if "title" in args:
             note.title = args["title"]
-        if "notebook" in args:
-            try:
-                note.notebookGuid = self.notebook_from_name(args["notebook"]).guid
-            except:
-                note.notebookGuid = None
         if "tags" in args:
             note.tagNames = extractTags(args["tags"])
 
@@ -621,8 +1232,16 @@ class SendToEvernoteCommand(EvernoteDoText):
         else:
             contents = view.substr(sublime.Region(0, view.size()))
 
-        notebooks = self.get_notebooks()
-        self.populate_note(note, contents)
+        notebooks = []
+
+        def prepare():
+            notebooks.extend(self.get_notebooks())
+            if "notebook" in args:
+                try:
+                    note.notebookGuid = self.notebook_from_name(args["notebook"]).guid
+                except:
+                    note.notebookGuid = None
+            self.populate_note(note, contents)
 
         def on_cancel():
             self.message("Note not sent.")
@@ -669,8 +1288,9 @@ class SendToEvernoteCommand(EvernoteDoText):
             LOG(note.content)
 
             try:
+                self.check_note(note)
                 self.message("Posting note, please wait...")
-                cnote = noteStore.createNote(self.token(), note)
+                cnote = self.get_note_store().createNote(self.token(), note)
                 if not clip:
                     set_view_metadata(view, cnote)
                     view.set_syntax_file(self.md_syntax)
@@ -685,17 +1305,18 @@ class SendToEvernoteCommand(EvernoteDoText):
                         self.connect(self.do_send, **args)
             except EDAMSystemException as e:
                 sublime.error_message('Evernote error:\n%s' % explain_error(e))
+            except ENMLValidationError as e:
+                sublime.error_message(explain_error(e))
             except Exception as e:
                 sublime.error_message('Evernote plugin error %s' % e)
 
-        choose_title()
+        call_async(prepare, lambda _: choose_title())
 
 
 class SaveEvernoteNoteCommand(EvernoteDoText):
 
     def do_run(self, edit, **args):
         note = Types.Note()
-        noteStore = self.get_note_store()
 
         on_save_completion = None
         if "on_completion" in args:
@@ -704,16 +1325,18 @@ class SaveEvernoteNoteCommand(EvernoteDoText):
         note.title = self.view.settings().get("$evernote_title")
         note.guid = self.view.settings().get("$evernote_guid")
 
-        self.populate_note(note, self.view)
-
         self.message("Updating note, please wait...")
 
         def __update_note():
             try:
-                cnote = noteStore.updateNote(self.token(), note)
+                self.populate_note(note, self.view)
+                self.check_note(note)
+                cnote = self.get_note_store().updateNote(self.token(), note)
                 set_view_metadata(self.view, cnote)
                 self.message("Successfully updated note: guid:%s" % cnote.guid)
                 self.update_status_info(cnote)
+            except ENMLValidationError as e:
+                sublime.error_message(explain_error(e))
             except Exception as e:
                 if sublime.ok_cancel_dialog('Evernote complained:\n\n%s\n\nRetry?' % explain_error(e)):
                     self.connect(self.__update_note)
@@ -736,12 +1359,12 @@ class DeleteEvernoteNoteCommand(EvernoteDoText):
             guid = self.view.settings().get("$evernote_guid")
         if guid:
             title = self.view.settings().get("$evernote_title", "Untitled")
-            noteStore = self.get_note_store()
             if not prompt or sublime.ok_cancel_dialog(DELETE_MSG % title):
-                noteStore.deleteNote(self.token(), guid)
-                self.view.settings().set("$evernote_guid", None)
-                self.view.settings().set("$evernote_modified", self.view.change_count())
-                self.view.close()
+                def on_deleted(usn):
+                    self.view.settings().set("$evernote_guid", None)
+                    self.view.settings().set("$evernote_modified", self.view.change_count())
+                    self.view.close()
+                call_async(lambda: self.get_note_store().deleteNote(self.token(), guid), on_deleted)
         return
 
     def is_enabled(self, **kw):
@@ -752,12 +1375,30 @@ class DeleteEvernoteNoteCommand(EvernoteDoText):
 
 class OpenEvernoteNoteCommand(EvernoteDoWindow):
 
-    def do_run(self, note_guid=None, by_searching=None,
-               from_notebook=None, with_tags=None,
-               order=None, ascending=None, max_notes=None, **kwargs):
-        notebooks = self.get_notebooks()
+    def do_run(self, note_guid=None, **kwargs):
+        if note_guid:
+            self.open_note(note_guid, **kwargs)
+            return
 
+        def prepare():
+            notebooks = self.get_notebooks()
+            if kwargs.get("with_tags"):
+                self.cache_all_tags()
+            try:
+                counts = self.get_note_counts()
+            except Exception as e:
+                LOG("Could not count notes", e)
+                counts = None
+            return notebooks, counts
+
+        call_async(prepare, lambda result: self.choose_note(*result, **kwargs))
+
+    def choose_note(self, notebooks, counts=None, by_searching=None,
+                    from_notebook=None, with_tags=None,
+                    order=None, ascending=None, max_notes=None, **kwargs):
         search_args = {}
+        page_size = max_notes or self.settings.get("max_notes", 100)
+        notebook_counts = (counts and counts.notebookCounts) or {}
 
         order = order or self.settings.get("notes_order", "default").upper()
         search_args['order'] = Types.NoteSortOrder._NAMES_TO_VALUES.get(order.upper())  # None = default
@@ -765,7 +1406,7 @@ class OpenEvernoteNoteCommand(EvernoteDoWindow):
 
         if from_notebook:
             try:
-                search_args['notebookGuid'] = self.notebook_from_name(from_notebook).guid
+                search_args['notebookGuid'] = dict((nb.name, nb.guid) for nb in notebooks)[from_notebook]
             except:
                 sublime.error_message("Notebook %s not found!" % from_notebook)
                 return
@@ -774,7 +1415,7 @@ class OpenEvernoteNoteCommand(EvernoteDoWindow):
             if isinstance(with_tags, str):
                 with_tags = [with_tags]
             try:
-                search_args['tagGuids'] = [self.tag_from_name(name) for name in with_tags]
+                search_args['tagGuids'] = [EvernoteDo._tag_guid_cache[name] for name in with_tags]
             except KeyError as e:
                 sublime.error_message("Tag %s not found!" % e)
 
@@ -800,21 +1441,46 @@ class OpenEvernoteNoteCommand(EvernoteDoWindow):
                 menu = [note.title for note in notes]
             self.window.show_quick_panel(menu, on_note)
 
+        def browse_panel(notes, total, selected=0):
+            # Notebooks with more than a page of notes are listed one page
+            # at a time, with an entry to search them instead.
+            menu = ["Search in this notebook…"] + [note.title for note in notes]
+            if len(notes) < total:
+                menu.append("More notes… (%d of %d shown)" % (len(notes), total))
+
+            def on_choice(i):
+                if i < 0:
+                    return
+                elif i == 0:
+                    self.window.show_input_panel(
+                        "Search in notebook:", "", do_search, None, None)
+                elif i <= len(notes):
+                    self.message('Retrieving note "%s"...' % notes[i-1].title)
+                    self.open_note(notes[i-1].guid, **kwargs)
+                else:
+                    self.message("Fetching notes list...")
+                    call_async(lambda: self.find_notes(search_args, page_size, len(notes)),
+                               lambda more: browse_panel(notes + more, total, len(notes) + 1))
+
+            self.window.show_quick_panel(menu, on_choice, 0, selected)
+
         def on_notebook(notebook):
             if notebook < 0:
                 return
+            self.message("Fetching notes list...")
             search_args['notebookGuid'] = notebooks[notebook].guid
-            notes = self.find_notes(search_args, max_notes)
-            async_do(lambda: notes_panel(notes), "Fetching notes list", done_msg=None)
+            total = notebook_counts.get(notebooks[notebook].guid, 0)
+            if total > page_size:
+                call_async(lambda: self.find_notes(search_args, page_size),
+                           lambda notes: browse_panel(notes, total))
+            else:
+                call_async(lambda: self.find_notes(search_args, max_notes), notes_panel)
 
         def do_search(query):
             self.message("Searching notes...")
             search_args['words'] = query
-            async_do(lambda: notes_panel(self.find_notes(search_args, max_notes), True), "Fetching notes list", done_msg=None)
-
-        if note_guid:
-            self.open_note(note_guid, **kwargs)
-            return
+            call_async(lambda: self.find_notes(search_args, max_notes),
+                       lambda notes: notes_panel(notes, True))
 
         if by_searching:
             if isinstance(by_searching, str):
@@ -826,7 +1492,8 @@ class OpenEvernoteNoteCommand(EvernoteDoWindow):
             return
 
         if from_notebook or with_tags:
-            notes_panel(self.find_notes(search_args, max_notes), not from_notebook)
+            call_async(lambda: self.find_notes(search_args, max_notes),
+                       lambda notes: notes_panel(notes, not from_notebook))
         elif len(notebooks) == 1:
             on_notebook(0)
         else:
@@ -834,13 +1501,16 @@ class OpenEvernoteNoteCommand(EvernoteDoWindow):
                 menu = ["%s » %s" % (nb.stack, nb.name) if nb.stack else nb.name for nb in notebooks]
             else:
                 menu = [nb.name for nb in notebooks]
+            if counts:
+                menu = [[name, "%d notes" % notebook_counts.get(nb.guid, 0)]
+                        for name, nb in zip(menu, notebooks)]
             self.window.show_quick_panel(menu, on_notebook)
 
-    def find_notes(self, search_args, max_notes=None):
+    def find_notes(self, search_args, max_notes=None, offset=None):
         return self.get_note_store().findNotesMetadata(
             self.token(),
             NoteStore.NoteFilter(**search_args),
-            None, max_notes or self.settings.get("max_notes", 100),
+            offset, max_notes or self.settings.get("max_notes", 100),
             NoteStore.NotesMetadataResultSpec(includeTitle=True, includeNotebookGuid=True)).notes
 
     def open_note(self, guid, convert=True, **unk_args):
@@ -857,34 +1527,7 @@ class OpenEvernoteNoteCommand(EvernoteDoWindow):
                 # tags = [noteStore.getTag(self.token(), guid).name for guid in (note.tagGuids or [])]
                 # tags = [self.tag_from_guid(guid) for guid in (note.tagGuids or [])]
                 tags = noteStore.getNoteTagNames(self.token(), note.guid)
-                meta = metadata_header(note.title, tags, nb_name)
-                builtin = note.content.find(SUBLIME_EVERNOTE_COMMENT_BEG, 0, 150)
-                if builtin >= 0:
-                    try:
-                        builtin_end = note.content.find(SUBLIME_EVERNOTE_COMMENT_END, builtin)
-                        bmdtxt = note.content[builtin+len(SUBLIME_EVERNOTE_COMMENT_BEG):builtin_end]
-                        mdtxt = b64decode(bmdtxt.encode('utf8')).decode('utf8')
-                        parts = extract_metadata(mdtxt)
-                        if parts["metadata"]:
-                            if parts["metadata"].get("title") == note.title and \
-                               "tags" in parts["metadata"] and \
-                               set(parts["metadata"].get("tags")) == set(tags) and \
-                               parts["metadata"].get("notebook") == nb_name:
-                                meta = ""
-                            else:
-                                LOG("Overridding metadata")
-                                mdtxt = parts["contents"]
-                        LOG("Loaded from built-in comment")
-                    except Exception as e:
-                        mdtxt = ""
-                        LOG("Loading from built-in comment failed", e)
-                if builtin < 0 or mdtxt == "":
-                    try:
-                        mdtxt = html2text.html2text(note.content)
-                        LOG("Conversion ok")
-                    except Exception as e:
-                        mdtxt = note.content
-                        LOG("Conversion failed", e)
+                note_contents = note_to_markdown(note, tags, nb_name, self.html2text_config)
 
                 if unk_args.get('open_new_file', True) == False:
                     newview = self.window.active_view()
@@ -892,7 +1535,6 @@ class OpenEvernoteNoteCommand(EvernoteDoWindow):
                     newview = self.window.new_file()
                 set_view_metadata(newview, note, False)
                 syntax = self.md_syntax
-                note_contents = meta+mdtxt
             else:
                 newview = self.window.new_file()
                 syntax = find_syntax("XML")
@@ -907,10 +1549,127 @@ class OpenEvernoteNoteCommand(EvernoteDoWindow):
             sublime.error_message(explain_error(e))
 
 
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+class AttachmentData():
+    """Body of an attachment with its size and MD5 digest.
+
+    Files are memory mapped: they are hashed one chunk at a time and the
+    mapping itself is handed to the Thrift writer, so the contents are
+    never loaded in the plugin host's memory as a whole.
+    """
+
+    def __init__(self, body, size, digest, on_close=None):
+        self.body = body
+        self.size = size
+        self.digest = digest
+        self.on_close = on_close
+
+    def hexdigest(self):
+        from binascii import hexlify
+        return hexlify(self.digest).decode('ascii')
+
+    def resource(self, mime, **attributes):
+        return Types.Resource(
+            # noteGuid=guid,
+            mime=mime,
+            data=Types.Data(body=self.body, size=self.size, bodyHash=self.digest),
+            attributes=Types.ResourceAttributes(**attributes))
+
+    def close(self):
+        if self.on_close:
+            self.on_close()
+            self.on_close = None
+
+    @staticmethod
+    def check_size(size, name="attachment"):
+        if size > Limits.EDAM_RESOURCE_SIZE_MAX_PREMIUM:
+            raise AttachmentTooLarge(
+                "The %s is %.1fMB, Evernote does not accept attachments "
+                "larger than %dMB (%dMB for free accounts)." % (
+                    name, size / 1048576.0,
+                    Limits.EDAM_RESOURCE_SIZE_MAX_PREMIUM // 1048576,
+                    Limits.EDAM_RESOURCE_SIZE_MAX_FREE // 1048576))
+
+    @classmethod
+    def from_bytes(cls, contents):
+        import hashlib
+        cls.check_size(len(contents))
+        return cls(contents, len(contents), hashlib.md5(contents).digest())
+
+    @classmethod
+    def from_file(cls, f, name="file"):
+        import hashlib, mmap
+        size = os.fstat(f.fileno()).st_size
+        cls.check_size(size, name)
+        if size == 0:
+            return cls(b"", 0, hashlib.md5().digest())
+        body = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        h = hashlib.md5()
+        view = memoryview(body)
+        try:
+            for i in range(0, size, ATTACHMENT_CHUNK_SIZE):
+                h.update(view[i:i + ATTACHMENT_CHUNK_SIZE])
+        finally:
+            view.release()
+        return cls(body, size, h.digest(), body.close)
+
+    @classmethod
+    def from_path(cls, path):
+        with open(path, 'rb') as f:
+            # the mapping stays valid after the file is closed
+            return cls.from_file(f, os.path.basename(path))
+
+    @classmethod
+    def from_url(cls, url):
+        """Download `url` into a temporary file and map it.
+
+        Returns the attachment data and the mime type declared by the server.
+        """
+        import tempfile, urllib.request
+        response = urllib.request.urlopen(url)
+        try:
+            length = response.info().get("Content-Length")
+            if length and length.isdigit():
+                cls.check_size(int(length), "download")
+            with tempfile.TemporaryFile() as tmp:
+                size = 0
+                while True:
+                    chunk = response.read(ATTACHMENT_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    cls.check_size(size, "download")
+                    tmp.write(chunk)
+                tmp.flush()
+                return cls.from_file(tmp, "download"), response.info().get_content_type()
+        finally:
+            response.close()
+
+
+def check_note_limits(note, attachment):
+    resources = note.resources or []
+    if len(resources) >= Limits.EDAM_NOTE_RESOURCES_MAX:
+        raise AttachmentTooLarge(
+            "A note cannot have more than %d attachments." % Limits.EDAM_NOTE_RESOURCES_MAX)
+    size = attachment.size + len((note.content or "").encode('utf8'))
+    size += sum(r.data.size or 0 for r in resources if r.data)
+    if size > Limits.EDAM_NOTE_SIZE_MAX_PREMIUM:
+        raise AttachmentTooLarge(
+            "With this attachment the note would be %.1fMB, "
+            "Evernote does not accept notes larger than %dMB." % (
+                size / 1048576.0, Limits.EDAM_NOTE_SIZE_MAX_PREMIUM // 1048576))
+
+
 class AttachToEvernoteNote(OpenEvernoteNoteCommand):
 
     def open_note(self, guid, insert_in_content=True, filename=None, prompt=False, **unk_args):
-        import hashlib, mimetypes
+        import mimetypes
         if filename is None:
             view = self.view
             if view is None:
@@ -918,6 +1677,11 @@ class AttachToEvernoteNote(OpenEvernoteNoteCommand):
                 return
             filename = view.file_name() or ""
             contents = view.substr(sublime.Region(0, view.size())).encode('utf8')
+            try:
+                data = AttachmentData.from_bytes(contents)
+            except AttachmentTooLarge as e:
+                sublime.error_message(explain_error(e))
+                return
         else:
             filename = os.path.abspath(filename)
             if prompt:
@@ -927,27 +1691,31 @@ class AttachToEvernoteNote(OpenEvernoteNoteCommand):
                     None, None)
                 return
             try:
-                with open(filename, 'rb') as content_file:
-                    contents = content_file.read()
+                data = AttachmentData.from_path(filename)
+            except AttachmentTooLarge as e:
+                sublime.error_message(explain_error(e))
+                return
             except Exception as e:
                 sublime.error_message("Evernote plugin could not open the file you specified!")
                 print(e)
                 return
-        try:
-            noteStore = self.get_note_store()
+        def do():
+            try:
+                attach(self.get_note_store())
+            except Exception as e:
+                sublime.error_message(explain_error(e))
+            finally:
+                data.close()
+
+        def attach(noteStore):
             note = noteStore.getNote(self.token(), guid, True, False, False, False)
+            check_note_limits(note, data)
             mime = mimetypes.guess_type(filename)[0]
             LOG(mime)
-            h = hashlib.md5(contents)
             if not isinstance(mime, str):
                 mime = "text/plain"
-            attachment = Types.Resource(
-                # noteGuid=guid,
-                mime=mime,
-                data=Types.Data(body=contents, size=len(contents), bodyHash=h.digest()),
-                attributes=Types.ResourceAttributes(
-                    fileName=os.path.basename(filename),
-                    attachment=True))
+            attachment = data.resource(
+                mime, fileName=os.path.basename(filename), attachment=True)
             resources = note.resources or []
             resources.append(attachment)
             if insert_in_content and note.content.endswith("</en-note>"):  # just a precaution
@@ -958,14 +1726,12 @@ class AttachToEvernoteNote(OpenEvernoteNoteCommand):
                 else:
                     content = note.content
                 note.content = content[0:-10] + \
-                    '<en-media type="%s" hash="%s"/></en-note>' % (mime, h.hexdigest())
+                    '<en-media type="%s" hash="%s"/></en-note>' % (mime, data.hexdigest())
             note.resources = resources
-            def do():
-                noteStore.updateNote(self.token(), note)
-                self.message("Successfully attached to note '%s'" % note.title)
-            async_do(do, "Uploading attachment")
-        except Exception as e:
-            sublime.error_message(explain_error(e))
+            noteStore.updateNote(self.token(), note)
+            self.message("Successfully attached to note '%s'" % note.title)
+
+        async_do(do, "Uploading attachment")
 
     def is_enabled(self, insert_in_content=True, filename=None, **unk):
         return filename is not None or self.window.active_view() is not None
@@ -974,12 +1740,13 @@ class AttachToEvernoteNote(OpenEvernoteNoteCommand):
 class InsertLinkToEvernoteNote(OpenEvernoteNoteCommand):
 
     def open_note(self, guid, **unk_args):
-        noteStore = self.get_note_store()
-        note = noteStore.getNote(self.token(), guid, False, False, False, False)
-        title = note.title
-        link = self.get_note_link(guid)
-        mdlink = '[{}]({})'.format(title, link)
-        insert_to_view(self.view, mdlink)
+        def insert_link(note):
+            link = self.get_note_link(guid)
+            mdlink = '[{}]({})'.format(note.title, link)
+            insert_to_view(self.view, mdlink)
+
+        call_async(lambda: self.get_note_store().getNote(
+            self.token(), guid, False, False, False, False), insert_link)
 
     def is_enabled(self, **kw):
         return bool(self.window.active_view().settings().get('$evernote', False))
@@ -1097,7 +1864,7 @@ class RevertToEvernoteCommand(OpenEvernoteNoteCommand):
 class EvernoteInsertAttachment(EvernoteDoText):
 
         def do_run(self, edit, insert_in_content=True, filename=None, prompt=False):
-            import hashlib, mimetypes, urllib
+            import mimetypes
             view = self.view
             if filename is None or prompt:
                 view.window().show_input_panel(
@@ -1108,50 +1875,45 @@ class EvernoteInsertAttachment(EvernoteDoText):
                     None, None)
                 return
             filename = filename.strip()
-            attr = {}
-            mimet = None
-            try:
-                if os.path.isfile(filename):
-                    datafile = os.path.expanduser(filename)
-                    with open(datafile, 'rb') as content_file:
-                        filecontents = content_file.read()
-                    attr = {"fileName": os.path.basename(datafile)}
-                else:
-                    # download
-                    response = urllib.request.urlopen(filename)
-                    filecontents = response.read()
-                    attr = {"sourceURL": filename}
-                    mimet = response.info().get_content_type()
-            except Exception as e:
-                sublime.error_message(
-                    "Evernote plugin has troubles locating the specified file/URL.\n" +
-                    explain_error(e))
-                return
 
             def upload_async():
+                attr = {}
+                mimet = None
+                try:
+                    if os.path.isfile(filename):
+                        datafile = os.path.expanduser(filename)
+                        data = AttachmentData.from_path(datafile)
+                        attr = {"fileName": os.path.basename(datafile)}
+                    else:
+                        # download
+                        data, mimet = AttachmentData.from_url(filename)
+                        attr = {"sourceURL": filename}
+                except Exception as e:
+                    sublime.error_message(
+                        "Evernote plugin has troubles locating the specified file/URL.\n" +
+                        explain_error(e))
+                    return
                 try:
                     guid = self.view.settings().get("$evernote_guid")
                     noteStore = self.get_note_store()
                     note = noteStore.getNote(self.token(), guid, False, False, False, False)
+                    check_note_limits(note, data)
                     mime = mimet or mimetypes.guess_type(filename)[0] or "application/octet-stream"
-                    h = hashlib.md5(filecontents)
-                    attachment = Types.Resource(
-                        # noteGuid=guid,
-                        mime=mime,
-                        data=Types.Data(body=filecontents, size=len(filecontents), bodyHash=h.digest()),
-                        attributes=Types.ResourceAttributes(attachment=not insert_in_content, **attr))
+                    attachment = data.resource(mime, attachment=not insert_in_content, **attr)
                     resources = note.resources or []
                     resources.append(attachment)
                     note.resources = resources
                     noteStore.updateNote(self.token(), note)
                     if insert_in_content:
-                        tag = '<en-media type="%s" hash="%s"/>' % (mime, h.hexdigest())
+                        tag = '<en-media type="%s" hash="%s"/>' % (mime, data.hexdigest())
                         view.run_command('insert', {'characters': tag})
                         sublime.set_timeout(lambda: view.run_command("save_evernote_note"), 10)
                 except Exception as e:
                     sublime.error_message(
                         "Evernote plugin cannot insert the attachment.\n" +
                         explain_error(e))
+                finally:
+                    data.close()
 
             async_do(upload_async, "Uploading attachment")
 
@@ -1175,12 +1937,95 @@ def hashstr(h):
     return ''.join(["%x" % b for b in h])
 
 
+class ResourceCache():
+    """Content addressed disk cache for the data of resources.
+
+    Files are named after the MD5 of their contents (`Data.bodyHash`) so
+    identical attachments of different notes are stored only once.
+    When the cache grows beyond `max_size` bytes the least recently used
+    files are evicted, down to 90% of it; the modification time of a file
+    is refreshed every time it is served from the cache. The total size is
+    kept as files are added, so the directory is only scanned to evict.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.size = None
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def path_for(self, body_hash, mime=None):
+        import mimetypes
+        from binascii import hexlify
+        ext = mimetypes.guess_extension(mime or "") or ""
+        return os.path.join(self.path, hexlify(body_hash).decode('ascii') + ext)
+
+    def get(self, body_hash, mime=None):
+        path = self.path_for(body_hash, mime)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        LOG("Resource served from cache", path)
+        return path
+
+    def put(self, body_hash, contents, mime=None):
+        path = self.path_for(body_hash, mime)
+        tmp = "%s.%d.part" % (path, threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(contents)
+        with self.lock:
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            os.replace(tmp, path)
+            if self.size is None:
+                self.evict(path)
+            else:
+                self.size += len(contents) - replaced
+                if self.size > self.max_size:
+                    self.evict(path)
+        return path
+
+    def evict(self, keep=None):
+        """Rescans the cache and removes the least recently used files
+        but `keep` until it fits again. Called with the lock held."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if name.endswith(".part"):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            total += st.st_size
+            if path != keep:
+                entries.append((st.st_mtime, st.st_size, path))
+        if total > self.max_size:
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_size * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+        self.size = total
+
+
 class EvernoteShowAttachments(EvernoteDoText):
 
     def do_run(self, edit):
         guid = self.view.settings().get("$evernote_guid")
-        noteStore = self.get_note_store()
-        note = noteStore.getNote(self.token(), guid, False, False, False, False)
+        call_async(lambda: self.get_note_store().getNote(
+            self.token(), guid, False, False, False, False), self.show_attachments)
+
+    def show_attachments(self, note):
         resources = note.resources or []
         menu = [[r.attributes.fileName or r.attributes.sourceURL or
                  ("Unnamed %s" % (r.mime or "")),
@@ -1194,14 +2039,21 @@ class EvernoteShowAttachments(EvernoteDoText):
             if i >= 0:
                 import tempfile, mimetypes
                 try:
-                    contents = noteStore.getResource(
-                        self.token(), note.resources[i].guid,
-                        True, False, False, False).data.body
                     mime = resources[i].mime or "application/octet-stream"
-                    _, tmp = tempfile.mkstemp(mimetypes.guess_extension(mime) or "")
+                    body_hash = resources[i].data.bodyHash
+                    cache = self.get_resource_cache()
+                    tmp = cache and cache.get(body_hash, mime)
+                    if tmp is None:
+                        contents = self.get_note_store().getResource(
+                            self.token(), note.resources[i].guid,
+                            True, False, False, False).data.body
+                        if cache:
+                            tmp = cache.put(body_hash, contents, mime)
+                        else:
+                            _, tmp = tempfile.mkstemp(mimetypes.guess_extension(mime) or "")
+                            with open(tmp, 'wb') as tmpf:
+                                tmpf.write(contents)
                     mime = mime.split("/")[0]
-                    with open(tmp, 'wb') as tmpf:
-                        tmpf.write(contents)
                     if mime in ["text", "image"]:
                         aview = self.view.window().open_file(tmp)
                         aview.set_read_only(True)
@@ -1224,37 +2076,487 @@ class EvernoteShowAttachments(EvernoteDoText):
         return False
 
 
+class EvernoteDownloadAttachmentsCommand(EvernoteDoWindow):
+    """Downloads all the attachments of a note or of a whole notebook into
+    the resource cache, fetching them in parallel."""
+
+    def do_run(self, note_guid=None, notebook=None):
+        if self.get_resource_cache() is None:
+            sublime.error_message("The resource cache is disabled: "
+                                  "set resource_cache_size to enable it.")
+            return
+        if note_guid is None and notebook is None and self.view:
+            note_guid = self.view.settings().get("$evernote_guid")
+        if note_guid:
+            return self.download([note_guid])
+        call_async(self.get_notebooks, lambda notebooks: self.choose_notebook(notebooks, notebook))
+
+    def choose_notebook(self, notebooks, notebook=None):
+        if not notebooks:
+            return
+        if notebook:
+            try:
+                guid = dict((nb.name, nb.guid) for nb in notebooks)[notebook]
+            except KeyError:
+                sublime.error_message("Notebook %s not found!" % notebook)
+                return
+            return self.download_notebook(guid)
+
+        def on_notebook(i):
+            if i >= 0:
+                self.download_notebook(notebooks[i].guid)
+
+        self.window.show_quick_panel([nb.name for nb in notebooks], on_notebook)
+
+    def download_notebook(self, notebook_guid):
+        def notes():
+            note_filter = NoteStore.NoteFilter(notebookGuid=notebook_guid)
+            for note in self.iter_notes(note_filter):
+                yield note.guid
+        self.download(notes())
+
+    def download(self, note_guids):
+        progress = BatchProgress("Downloading attachments")
+        sublime.set_timeout_async(lambda: self.do_download(note_guids, progress), 0)
+        progress.show()
+
+    def do_download(self, note_guids, progress):
+        from concurrent.futures import ThreadPoolExecutor
+        cache = self.get_resource_cache()
+        token = self.token()
+        seen = set()
+
+        def fetch_resources(guid):
+            try:
+                return self.get_note_store().getNote(
+                    token, guid, False, False, False, False).resources or []
+            except Exception as e:
+                # Counted as one failure: the attachments of the note are unknown
+                LOG("Could not list the attachments of note", guid, e)
+                progress.add(total=1, failed=1)
+                return []
+
+        def fetch_data(resource):
+            try:
+                body = self.get_note_store().getResourceData(token, resource.guid)
+                cache.put(resource.data.bodyHash, body, resource.mime)
+                progress.add(done=1, size=len(body))
+            except Exception as e:
+                LOG("Could not download resource", resource.guid, e)
+                progress.add(failed=1)
+
+        workers = self.settings.get("download_workers", 4)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for resources in pool.map(fetch_resources, note_guids):
+                    for r in resources:
+                        if r.data.bodyHash in seen:
+                            continue
+                        seen.add(r.data.bodyHash)
+                        progress.add(total=1)
+                        # Files already in the cache were fetched by an earlier
+                        # (possibly interrupted) run and are not downloaded again
+                        if cache.get(r.data.bodyHash, r.mime):
+                            progress.add(skipped=1)
+                        else:
+                            pool.submit(fetch_data, r)
+        except Exception as e:
+            sublime.error_message(explain_error(e))
+        finally:
+            progress.finish()
+
+
+def safe_filename(name, default="Untitled"):
+    name = re.sub(r'[\\/:*?"<>|\x00-\x1f]+', "_", name or "").strip(" .")
+    return name[:120] or default
+
+
+class ExportEvernoteNotesCommand(EvernoteDoWindow):
+    """Exports the notes of a notebook, of a tag or matching a search
+    to markdown files, together with their attachments."""
+
+    def do_run(self, folder=None, notebook=None, tag=None, query=None, attachments=True):
+        def prepare():
+            notebooks = self.get_notebooks()
+            if tag:
+                try:
+                    self.tag_from_name(tag)  # To trigger caching
+                except KeyError:
+                    pass
+            return notebooks
+
+        call_async(prepare, lambda notebooks: self.choose_notes(
+            notebooks, folder, notebook, tag, query, attachments))
+
+    def choose_notes(self, notebooks, folder, notebook, tag, query, attachments):
+        if not notebooks:
+            return
+        note_filter = NoteStore.NoteFilter()
+        if notebook:
+            try:
+                note_filter.notebookGuid = dict((nb.name, nb.guid) for nb in notebooks)[notebook]
+            except KeyError:
+                sublime.error_message("Notebook %s not found!" % notebook)
+                return
+        if tag:
+            try:
+                note_filter.tagGuids = [EvernoteDo._tag_guid_cache[tag]]
+            except KeyError:
+                sublime.error_message("Tag %s not found!" % tag)
+                return
+        if isinstance(query, str):
+            note_filter.words = query
+
+        def on_folder(path):
+            path = os.path.expanduser(path.strip())
+            if path:
+                self.export(note_filter, path, attachments)
+
+        def ask_folder():
+            if folder:
+                on_folder(folder)
+            else:
+                self.window.show_input_panel(
+                    "Export to folder:", os.path.expanduser(os.path.join("~", "Evernote")),
+                    on_folder, None, None)
+
+        if query is True:
+            def on_query(words):
+                note_filter.words = words
+                ask_folder()
+            self.window.show_input_panel("Enter search query:", "", on_query, None, None)
+            return
+
+        if notebook or tag or query:
+            return ask_folder()
+
+        def on_notebook(i):
+            if i >= 0:
+                note_filter.notebookGuid = notebooks[i].guid
+                ask_folder()
+
+        self.window.show_quick_panel([nb.name for nb in notebooks], on_notebook)
+
+    def export(self, note_filter, folder, attachments=True):
+        progress = BatchProgress("Exporting notes")
+        sublime.set_timeout_async(
+            lambda: self.do_export(note_filter, folder, attachments, progress), 0)
+        progress.show()
+
+    def do_export(self, note_filter, folder, attachments, progress):
+        from concurrent.futures import ThreadPoolExecutor
+        token = self.token()
+        workers = self.settings.get("download_workers", 4)
+        # At most this many notes are held in memory at any time: listing
+        # waits for a free slot before handing a note to the workers.
+        slots = threading.BoundedSemaphore(2 * workers)
+        names = set()
+        names_lock = threading.Lock()
+
+        def unique_name(title):
+            name = base = safe_filename(title)
+            with names_lock:
+                i = 1
+                while name.lower() in names:
+                    i += 1
+                    name = "%s (%d)" % (base, i)
+                names.add(name.lower())
+            return name
+
+        def export_note(guid):
+            try:
+                noteStore = self.get_note_store()
+                note = noteStore.getNote(token, guid, True, False, False, False)
+                tags = noteStore.getNoteTagNames(token, guid)
+                contents = note_to_markdown(
+                    note, tags, self.notebook_from_guid(note.notebookGuid).name,
+                    self.html2text_config)
+                contents = contents.encode("utf-8")
+                name = unique_name(note.title)
+                with open(os.path.join(folder, name + ".md"), "wb") as f:
+                    f.write(contents)
+                size = len(contents)
+                if attachments and note.resources:
+                    size += self.export_resources(
+                        note.resources, os.path.join(folder, name + " attachments"))
+                progress.add(done=1, size=size)
+            except Exception as e:
+                LOG("Could not export note", guid, e)
+                progress.add(failed=1)
+            finally:
+                slots.release()
+
+        try:
+            os.makedirs(folder, exist_ok=True)
+            self.get_notebooks()  # To trigger caching before starting the workers
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for note in self.iter_notes(note_filter):
+                    slots.acquire()
+                    progress.add(total=1)
+                    pool.submit(export_note, note.guid)
+        except Exception as e:
+            sublime.error_message(explain_error(e))
+        finally:
+            progress.finish()
+
+    def export_resources(self, resources, folder):
+        import mimetypes
+        import shutil
+        from binascii import hexlify
+        os.makedirs(folder, exist_ok=True)
+        cache = self.get_resource_cache()
+        names = set()
+        size = 0
+        for r in resources:
+            hexhash = hexlify(r.data.bodyHash).decode("ascii")
+            name = base = safe_filename(
+                r.attributes and r.attributes.fileName,
+                hexhash + (mimetypes.guess_extension(r.mime or "") or ""))
+            if name in names:
+                name = hexhash[:8] + "-" + base
+            names.add(name)
+            path = os.path.join(folder, name)
+            cached = cache and cache.get(r.data.bodyHash, r.mime)
+            if cached:
+                shutil.copyfile(cached, path)
+                size += os.path.getsize(path)
+                continue
+            body = self.get_note_store().getResourceData(self.token(), r.guid)
+            if cache:
+                cache.put(r.data.bodyHash, body, r.mime)
+            with open(path, "wb") as f:
+                f.write(body)
+            size += len(body)
+        return size
+
+
+MARKDOWN_EXTENSIONS = (".md", ".markdown", ".mdown", ".mkd", ".mkdn")
+
+
+class ImportMarkdownFolderCommand(EvernoteDoWindow):
+    """Creates a note for each markdown file in a folder (recursively).
+
+    Title, tags and notebook are read from the metadata header of each
+    file; the title defaults to the file name and the notebook to the one
+    selected when starting the import.
+    Files are rendered in parallel while a single uploader sends the notes,
+    waiting whenever Evernote reports that the rate limit was reached.
+    """
+
+    def do_run(self, folder=None, notebook=None, dedupe="title"):
+        call_async(self.get_notebooks, lambda notebooks: self.choose_folder(
+            notebooks, folder, notebook, dedupe))
+
+    def choose_folder(self, notebooks, folder, notebook, dedupe):
+        if not notebooks:
+            return
+
+        def on_notebook(i):
+            if i >= 0:
+                self.start_import(folder, notebooks[i].guid, dedupe)
+
+        def on_folder(path):
+            nonlocal folder
+            folder = os.path.expanduser(path.strip())
+            if not os.path.isdir(folder):
+                sublime.error_message("Folder %s not found!" % folder)
+            elif notebook:
+                try:
+                    guid = dict((nb.name, nb.guid) for nb in notebooks)[notebook]
+                except KeyError:
+                    sublime.error_message("Notebook %s not found!" % notebook)
+                else:
+                    self.start_import(folder, guid, dedupe)
+            else:
+                self.window.show_quick_panel([nb.name for nb in notebooks], on_notebook)
+
+        if folder:
+            on_folder(folder)
+        else:
+            self.window.show_input_panel("Import markdown files from folder:", "",
+                                         on_folder, None, None)
+
+    def start_import(self, folder, notebook_guid, dedupe):
+        progress = BatchProgress("Importing notes")
+        sublime.set_timeout_async(
+            lambda: self.do_import(folder, notebook_guid, dedupe, progress), 0)
+        progress.show()
+
+    def existing_notes(self, dedupe):
+        """Returns the keys identifying the notes already in the account:
+        (notebook guid, title) pairs or, when deduplicating by hash, the
+        MD5 of their contents."""
+        if dedupe == "hash":
+            # The notes of sync chunks come without their contents but with
+            # their hash, which the metadata of findNotesMetadata lacks.
+            chunk_filter = NoteStore.SyncChunkFilter(includeNotes=True)
+            hashes = {}
+            usn = 0
+            update_count = self.get_note_store().getSyncState(self.token()).updateCount
+            while usn < update_count:
+                chunk = self.get_note_store().getFilteredSyncChunk(
+                    self.token(), usn, 256, chunk_filter)
+                for note in chunk.notes or []:
+                    hashes[note.guid] = note.contentHash if note.active else None
+                if chunk.chunkHighUSN is None:
+                    break
+                usn = chunk.chunkHighUSN
+            return set(hashes.values()) - set([None])
+        spec = NoteStore.NotesMetadataResultSpec(
+            includeTitle=True, includeNotebookGuid=True)
+        existing = {}
+        for note in self.iter_notes(NoteStore.NoteFilter(), spec, page_size=250):
+            existing[(note.notebookGuid, note.title)] = note.guid
+        return existing
+
+    def do_import(self, folder, notebook_guid, dedupe, progress):
+        from concurrent.futures import ThreadPoolExecutor
+        import queue
+        import hashlib
+
+        paths = []
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            paths.extend(os.path.join(root, f) for f in sorted(files)
+                         if f.lower().endswith(MARKDOWN_EXTENSIONS))
+        progress.add(total=len(paths))
+        workers = self.settings.get("download_workers", 4)
+        # Rendered notes wait here for the uploader; renderers block when
+        # it is full so memory stays bounded on large folders.
+        uploads = queue.Queue(2 * workers)
+        # Set when the uploader stops, so renderers stop waiting for room
+        uploader_stopped = threading.Event()
+        existing_lock = threading.Lock()
+
+        def queue_upload(path, note):
+            while not uploader_stopped.is_set():
+                try:
+                    uploads.put((path, note), timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def render(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    contents = f.read()
+                note = Types.Note()
+                note.title = os.path.splitext(os.path.basename(path))[0]
+                note.notebookGuid = notebook_guid
+                self.populate_note(note, contents, notebooks)
+                self.check_note(note)
+                if dedupe == "hash":
+                    key = hashlib.md5(note.content.encode("utf-8")).digest()
+                else:
+                    key = (note.notebookGuid, note.title)
+                with existing_lock:
+                    duplicate = dedupe and key in existing
+                    if dedupe == "hash":
+                        existing.add(key)
+                    else:
+                        existing[key] = None
+                if duplicate:
+                    LOG("Skipping existing note", path)
+                    progress.add(skipped=1)
+                    return
+                if not queue_upload(path, note):
+                    LOG("Not uploaded, the uploader stopped", path)
+                    progress.add(failed=1)
+            except Exception as e:
+                LOG("Could not render", path, e)
+                progress.add(failed=1)
+
+        def upload():
+            try:
+                upload_all()
+            except Exception as e:
+                LOG("The uploader stopped", e)
+                sublime.error_message(explain_error(e))
+            finally:
+                uploader_stopped.set()
+
+        def upload_all():
+            noteStore = self.get_note_store()
+            while True:
+                item = uploads.get()
+                if item is None:
+                    return
+                path, note = item
+                while True:
+                    try:
+                        noteStore.createNote(self.token(), note)
+                        progress.add(done=1, size=len(note.content))
+                    except EDAMSystemException as e:
+                        if e.errorCode == EDAMErrorCode.RATE_LIMIT_REACHED:
+                            wait = e.rateLimitDuration or 60
+                            LOG("Rate limit reached, waiting %ss" % wait)
+                            msg = progress.msg
+                            progress.msg = "Importing notes (rate limit reached, waiting %ss)" % wait
+                            time.sleep(wait)
+                            progress.msg = msg
+                            continue
+                        LOG("Could not upload", path, e)
+                        progress.add(failed=1)
+                    except Exception as e:
+                        LOG("Could not upload", path, e)
+                        progress.add(failed=1)
+                    break
+
+        uploader = threading.Thread(target=upload)
+        try:
+            existing = self.existing_notes(dedupe) if dedupe else {}
+            # Fetched once here rather than from each renderer
+            notebooks = self.get_notebooks()
+            uploader.start()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                pool.map(render, paths)
+        except Exception as e:
+            sublime.error_message(explain_error(e))
+        finally:
+            while uploader.is_alive():
+                try:
+                    uploads.put(None, timeout=1)
+                    uploader.join()
+                except queue.Full:
+                    pass
+            # Left over if the uploader stopped early
+            while not uploads.empty():
+                if uploads.get() is not None:
+                    progress.add(failed=1)
+            progress.finish()
+
+
 class EvernoteDeleteAttachment(EvernoteDoText):
 
         def do_run(self, edit, attachment_hash=None, attachment_index=None):
             guid = self.view.settings().get("$evernote_guid")
-            noteStore = self.get_note_store()
-            note = noteStore.getNote(self.token(), guid, False, False, False, False)
+            call_async(lambda: self.get_note_store().getNote(
+                self.token(), guid, False, False, False, False),
+                lambda note: self.delete_attachment(note, attachment_hash, attachment_index))
 
+        def delete_attachment(self, note, attachment_hash=None, attachment_index=None):
             if attachment_hash or attachment_index:
-                try:
-                    if attachment_hash is None:
-                        attachment_hash = hashstr(note.resources[attachment_index].data.bodyHash)
+                if attachment_hash is None:
+                    attachment_hash = hashstr(note.resources[attachment_index].data.bodyHash)
+                if attachment_index is None:
+                    for r in range(len(note.resources)):
+                        if hashstr(note.resources[r].data.bodyHash) == attachment_hash:
+                            attachment_index = r
                     if attachment_index is None:
-                        for r in range(len(note.resources)):
-                            if hashstr(note.resources[r].data.bodyHash) == attachment_hash:
-                                attachment_index = r
-                        if attachment_index is None:
-                            sublime.error_message("Attachment not found!")
-                            return
+                        sublime.error_message("Attachment not found!")
+                        return
 
+                def update():
                     note.resources.pop(attachment_index)
-                    noteStore.updateNote(self.token(), note)
+                    self.get_note_store().updateNote(self.token(), note)
 
-                    regions = self.view.find_all(
-                        r'<en-media [^>]*hash\s*=\s*["\']'+attachment_hash+'["\'][^>]*/>',
-                        sublime.IGNORECASE)
-                    for region in reversed(regions):
-                        self.view.erase(edit, region)
-
-                except Exception as e:
+                def on_error(e):
                     sublime.error_message(
                         "Unable to delete the attachment.\n%s" % explain_error(e))
+
+                call_async(update, lambda _: self.view.run_command(
+                    "erase_evernote_media", {"attachment_hash": attachment_hash}), on_error)
             else:
                 resources = note.resources or []
                 menu = [[r.attributes.fileName or r.attributes.sourceURL or
@@ -1372,9 +2674,10 @@ class CreateNotebookCommand(EvernoteDoWindow):
             if not notebook:
                 sublime.error_message("Notebook name is required")
             else:
-                new_notebook = self.create_notebook(notebook)
-                if new_notebook:
-                    self.message("Newly created notebook: %s" % notebook)
+                def on_created(new_notebook):
+                    if new_notebook:
+                        self.message("Newly created notebook: %s" % notebook)
+                call_async(lambda: self.create_notebook(notebook), on_created)
 
         self.window.show_input_panel(
             "Notebook name (required):", "",
@@ -1389,6 +2692,15 @@ class ClearEvernoteCacheCommand(sublime_plugin.WindowCommand):
         LOG("Cache cleared!")
 
 
+class EraseEvernoteMediaCommand(sublime_plugin.TextCommand):
+    def run(self, edit, attachment_hash):
+        regions = self.view.find_all(
+            r'<en-media [^>]*hash\s*=\s*["\']'+attachment_hash+'["\'][^>]*/>',
+            sublime.IGNORECASE)
+        for region in reversed(regions):
+            self.view.erase(edit, region)
+
+
 class ReplaceViewTextCommand(sublime_plugin.TextCommand):
     def run(self, edit, characters):
         self.view.erase(edit, sublime.Region(0, self.view.size()))
@@ -1455,17 +2767,42 @@ class EvernoteListener(EvernoteDo, sublime_plugin.EventListener):
         loc = locations[0]
         if not view.scope_name(loc).startswith("text.html.markdown.evernote meta.metadata.evernote"):
             return None
-        if self.first_time:
-            self.cache_all_tags()
-            self.first_time = False
+        if self.first_time and not EvernoteDo._notebooks_cache:
+            # Completions are offered once the lists have been fetched
+            # in the background; failing to fetch them is not worth a dialog
+            def prefetch():
+                self.cache_all_tags()
+                self.set_notebooks(self.get_note_store().listNotebooks(self.token()))
+            call_async(prefetch, on_error=lambda e: LOG("Could not fetch completions", e))
+        self.first_time = False
+
+        # Note counts are shown if a panel already fetched them
+        counts = EvernoteDo._note_counts[1] if EvernoteDo._note_counts else None
+        tag_counts = (counts and counts.tagCounts) or {}
+        notebook_counts = (counts and counts.notebookCounts) or {}
+        notebooks = EvernoteDo._notebook_by_name or {}
+
+        def hint(name, n):
+            return "%s\t%d notes" % (name, n) if n else name
 
         line = view.substr(view.line(loc)).lstrip()
         if line.startswith("tags"):
-            return [[tag, tag] for tag in EvernoteDo._tag_name_cache.values() if tag.startswith(prefix)]
+            return [[hint(tag, tag_counts.get(EvernoteDo._tag_guid_cache.get(tag))), tag]
+                    for tag in EvernoteDo._tag_index.search(prefix)]
         elif line.startswith("notebook"):
-            return [[nb.name, nb.name] for nb in self.get_notebooks() if nb.name.startswith(prefix)]
+            return [[hint(nb, nb in notebooks and notebook_counts.get(notebooks[nb].guid)), nb]
+                    for nb in EvernoteDo._notebook_index.search(prefix)]
         return None
 
 
 def plugin_loaded():
     EvernoteListener.load_settings(EvernoteListener)
+    warm = EvernoteDo()
+    warm.load_settings()
+    if warm.token() and warm.settings.get("noteStoreUrl"):
+        call_async(warm.warm_up, on_error=lambda e: LOG("Warm-up failed", e))
+
+
+def plugin_unloaded():
+    if _executor is not None:
+        _executor.shutdown(wait=False)